@@ -0,0 +1,170 @@
+"""Gerador de ensaios sintéticos e benchmark das etapas da análise Head to Head.
+
+Uso:
+
+    python benchmark_h2h.py --escalas 50x20x2 200x40x3 --salvar tempos.csv
+    python benchmark_h2h.py --comparar tempos.csv
+
+Cada escala é FAZENDASxCULTIVARESxREPETICOES.
+"""
+import argparse
+import io
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import h2h
+from h2h import COLUNAS_NECESSARIAS, IndiceFiltros, ResultadoH2H, exportar, ler_excel
+
+ESCALAS_PADRAO = ["50x20x2", "200x40x3", "500x60x3"]
+
+ESTADOS = {
+    "MT": ["Sorriso", "Sinop", "Lucas do Rio Verde", "Primavera do Leste", "Campo Verde"],
+    "GO": ["Rio Verde", "Jataí", "Cristalina", "Mineiros"],
+    "PR": ["Cascavel", "Toledo", "Guarapuava", "Ponta Grossa"],
+    "MS": ["Dourados", "Maracaju", "Chapadão do Sul"],
+    "BA": ["Luís Eduardo Magalhães", "Barreiras"]
+}
+
+
+def gerar_ensaio(n_fazendas, n_cultivares, repeticoes=1, presenca=0.8, semente=0):
+    """DataFrame de ensaio sintético com as colunas de COLUNAS_NECESSARIAS.
+
+    Cada fazenda recebe cerca de `presenca` dos cultivares, cada um em `repeticoes`
+    linhas; a produtividade soma efeito de fazenda, de cultivar e ruído.
+    """
+    rng = np.random.default_rng(semente)
+
+    estados = rng.choice(list(ESTADOS), n_fazendas)
+    cidades = np.array([rng.choice(ESTADOS[uf]) for uf in estados])
+    safras = rng.choice(["2022/2023", "2023/2024", "2024/2025"], n_fazendas)
+    plantio = pd.to_datetime("2023-09-15") + pd.to_timedelta(rng.integers(0, 60, n_fazendas), unit="D")
+    efeito_fazenda = rng.normal(0, 8, n_fazendas)
+    efeito_cultivar = rng.normal(0, 4, n_cultivares)
+    gm_cultivar = rng.integers(55, 85, n_cultivares)
+
+    fazenda, cultivar = np.nonzero(rng.random((n_fazendas, n_cultivares)) < presenca)
+    fazenda, cultivar = np.repeat(fazenda, repeticoes), np.repeat(cultivar, repeticoes)
+    n = fazenda.size
+
+    prod_sc_ha = np.round(np.clip(65 + efeito_fazenda[fazenda] + efeito_cultivar[cultivar] + rng.normal(0, 3, n), 5, None), 1)
+    df = pd.DataFrame({
+        "Fazenda": [f"Fazenda {i:05d}" for i in fazenda],
+        "Produtor": [f"Produtor {i // 3:05d}" for i in fazenda],
+        "Cidade": cidades[fazenda],
+        "Microrregiao": [f"Micro {c[:3].upper()}" for c in cidades[fazenda]],
+        "Estado": estados[fazenda],
+        "UF": estados[fazenda],
+        "Plantio": plantio[fazenda],
+        "Colheita": plantio[fazenda] + pd.to_timedelta(gm_cultivar[cultivar] + 50, unit="D"),
+        "Cultivar": [f"CV {i:04d}" for i in cultivar],
+        "GM": gm_cultivar[cultivar],
+        "Pop_Final": rng.integers(200_000, 320_000, n),
+        "Umidade (%)": np.round(rng.uniform(12, 18, n), 1),
+        "prod_kg_ha": np.round(prod_sc_ha * 60, 0),
+        "prod_sc_ha": prod_sc_ha,
+        "Safra": safras[fazenda]
+    })
+    return df[COLUNAS_NECESSARIAS]
+
+
+def gerar_planilha(df):
+    """Bytes de um .xlsx com o ensaio, como o usuário faria upload."""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+        df.to_excel(writer, index=False, sheet_name="Ensaio")
+    return buffer.getvalue()
+
+
+def _medir(etapa, funcao):
+    """Executa `funcao` duas vezes: uma cronometrada e outra medindo o pico de memória alocada (MB).
+
+    O tracemalloc deixa o código bem mais lento, por isso não entra na medida de tempo.
+    O cache de exportação é esvaziado antes de cada execução.
+    """
+    h2h._cache_exportacao.clear()
+    inicio = time.perf_counter()
+    valor = funcao()
+    segundos = time.perf_counter() - inicio
+
+    h2h._cache_exportacao.clear()
+    tracemalloc.start()
+    funcao()
+    pico = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return valor, {"Etapa": etapa, "Segundos": round(segundos, 3), "Pico_MB": round(pico, 1)}
+
+
+def medir_escala(n_fazendas, n_cultivares, repeticoes, semente=0):
+    """Tempo e memória de cada etapa do app para uma escala."""
+    planilha = gerar_planilha(gerar_ensaio(n_fazendas, n_cultivares, repeticoes, semente=semente))
+    medidas = []
+
+    df, medida = _medir("Leitura Excel", lambda: ler_excel(io.BytesIO(planilha)))
+    medidas.append(medida)
+
+    def filtrar():
+        dados = IndiceFiltros(df)
+        estados = dados.opcoes("Estado")
+        mascara = dados.restringir(None, "Estado", estados[: max(1, len(estados) // 2)])
+        minimo, maximo = dados.faixa("GM", mascara)
+        return dados.filtrar(dados.restringir_faixa(mascara, "GM", minimo, (minimo + maximo) / 2))
+
+    df_filtrado, medida = _medir("Filtros", filtrar)
+    medidas.append(medida)
+
+    resultado, medida = _medir("Pares H2H", lambda: ResultadoH2H(df))
+    medidas.append(medida)
+
+    def multi_check():
+        head = resultado.cultivares[0]
+        checks = resultado.cultivares[1:11]
+        return resultado.resumo(head, checks), resultado.media_head(head, checks)
+
+    medidas.append(_medir("Multi-check", multi_check)[1])
+    # Sem o cache do objeto, para medir o ajuste nas duas execuções
+    medidas.append(_medir("Ranking", resultado._ajustar_ranking)[1])
+    medidas.append(_medir("Exportar xlsx", lambda: exportar(resultado.tabela(), "Excel", "Resultado H2H"))[1])
+
+    escala = f"{n_fazendas}x{n_cultivares}x{repeticoes}"
+    for medida in medidas:
+        medida.update({"Escala": escala, "Linhas": len(df), "Linhas_filtradas": len(df_filtrado), "Pares": len(resultado)})
+    return medidas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark das etapas da análise Head to Head.")
+    parser.add_argument("--escalas", nargs="+", default=ESCALAS_PADRAO, help="FAZENDASxCULTIVARESxREPETICOES")
+    parser.add_argument("--semente", type=int, default=0)
+    parser.add_argument("--salvar", help="grava os resultados em CSV")
+    parser.add_argument("--comparar", help="CSV de uma execução anterior para comparar os tempos")
+    parser.add_argument("--gerar", help="só grava um ensaio sintético (.xlsx) da primeira escala neste caminho")
+    args = parser.parse_args(argv)
+
+    escalas = [tuple(int(n) for n in escala.lower().split("x")) for escala in args.escalas]
+
+    if args.gerar:
+        with open(args.gerar, "wb") as arquivo:
+            arquivo.write(gerar_planilha(gerar_ensaio(*escalas[0], semente=args.semente)))
+        return 0
+
+    medidas = []
+    for escala in escalas:
+        medidas.extend(medir_escala(*escala, semente=args.semente))
+    tabela = pd.DataFrame(medidas)[["Escala", "Etapa", "Linhas", "Linhas_filtradas", "Pares", "Segundos", "Pico_MB"]]
+
+    if args.comparar:
+        anterior = pd.read_csv(args.comparar)[["Escala", "Etapa", "Segundos"]]
+        tabela = tabela.merge(anterior, on=["Escala", "Etapa"], how="left", suffixes=("", "_anterior"))
+        tabela["Razao"] = (tabela["Segundos"] / tabela["Segundos_anterior"]).round(2)
+
+    print(tabela.to_string(index=False))
+    if args.salvar:
+        tabela.to_csv(args.salvar, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,1697 @@
+"""Motor de cálculo da análise Head to Head.
+
+Também pode ser usado sem a interface, para pré-calcular resultados:
+
+    python -m h2h planilha.xlsx [outra.xlsx ...] --saida resultados --formato parquet
+"""
+import argparse
+import copy
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import threading
+import time
+import tracemalloc
+import weakref
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import xlsxwriter
+from cachetools import LRUCache
+from decouple import config
+from openpyxl.utils.exceptions import InvalidFileException
+from pandas.api.types import union_categoricals
+from pyarrow import fs
+
+
+# Colunas mantidas após a leitura do Excel
+COLUNAS_NECESSARIAS = [
+    "Fazenda", "Produtor", "Cidade", "Microrregiao", "Estado", "UF",
+    "Plantio", "Colheita", "Cultivar", "GM",
+    "Pop_Final", "Umidade (%)", "prod_kg_ha", "prod_sc_ha",
+    "Safra"
+]
+
+# Sem elas não há análise Head to Head
+COLUNAS_OBRIGATORIAS = ["Fazenda", "Cultivar", "prod_sc_ha"]
+
+COLUNAS_CATEGORICAS = ["Fazenda", "Produtor", "Cidade", "Microrregiao", "Estado", "UF", "Cultivar", "Safra"]
+COLUNAS_NUMERICAS = ["GM", "prod_kg_ha", "prod_sc_ha"]
+
+# Colunas com filtro por valores (multiselect) e por faixa (slider)
+COLUNAS_FILTRO = ["Safra", "Microrregiao", "Estado", "Cidade"]
+COLUNAS_FAIXA = ["GM"]
+
+RENOMEAR_COLUNAS = {
+    "Material": "Cultivar",
+    "Produtividade": "prod_sc_ha"
+}
+
+# Linhas convertidas por vez durante a leitura do Excel
+LINHAS_POR_BLOCO = 50_000
+
+
+class ErroIngestao(ValueError):
+    """Arquivo de ensaio que não pode ser carregado."""
+
+
+def _tamanho_df(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+# Cache de arquivos já lidos (com seus índices de filtro), compartilhado por todas as
+# sessões do servidor. O orçamento de memória (MB) vem da variável H2H_CACHE_MB.
+_cache_ingestao = LRUCache(maxsize=config("H2H_CACHE_MB", default=512, cast=int) * 1024 ** 2, getsizeof=lambda dados: dados.tamanho())
+_trava_ingestao = threading.Lock()
+_travas_arquivo = {}
+
+
+def _limpar(df):
+    """Converte as medidas para numérico e remove linhas com prod inválido ou faltantes."""
+    df = df.copy()
+    for col in COLUNAS_NUMERICAS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    return df[df["prod_sc_ha"] > 0].dropna()
+
+
+def _categorizar(df):
+    for col in COLUNAS_CATEGORICAS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+
+def _juntar_blocos(partes):
+    """Concatena blocos já categorizados, unificando as categorias de cada coluna.
+
+    Assim nenhum momento da leitura guarda as colunas de rótulo inteiras como objetos.
+    """
+    partes = [parte for parte in partes if len(parte)] or partes[:1]
+    for col in partes[0].columns:
+        if not isinstance(partes[0][col].dtype, pd.CategoricalDtype):
+            continue
+        colunas = [parte[col] for parte in partes]
+        if len({serie.cat.categories.dtype for serie in colunas}) > 1:
+            # Ex.: Safra só numérica num bloco e texto em outro
+            colunas = [serie.cat.set_categories(serie.cat.categories.astype(object)) for serie in colunas]
+        try:
+            categorias = union_categoricals(colunas, sort_categories=True).categories
+        except TypeError:
+            # Valores que não se comparam ficam na ordem em que aparecem, como em astype("category")
+            categorias = union_categoricals(colunas).categories
+        tipo = pd.CategoricalDtype(categorias)
+        for parte, serie in zip(partes, colunas):
+            parte[col] = serie.astype(tipo)
+    return pd.concat(partes, ignore_index=True)
+
+
+def normalizar_dados(df):
+    """Renomeia colunas, tipa, remove linhas inválidas e mantém só as colunas usadas."""
+    df = df.rename(columns=RENOMEAR_COLUNAS)
+
+    faltando = [col for col in COLUNAS_OBRIGATORIAS if col not in df.columns]
+    if faltando:
+        raise ErroIngestao(f"Colunas obrigatórias ausentes: {', '.join(faltando)}")
+
+    colunas_disponiveis = [col for col in COLUNAS_NECESSARIAS if col in df.columns]
+    return _categorizar(_limpar(df[colunas_disponiveis]))
+
+
+# Uma linha por parcela vira uma linha por (Safra, Fazenda, Cultivar); estas colunas viram médias
+COLUNAS_REPETICAO = ["Safra", "Fazenda", "Cultivar"]
+COLUNAS_MEDIA = ["prod_sc_ha", "prod_kg_ha", "Umidade (%)"]
+
+
+def agregar_repeticoes(df):
+    """Uma linha por (Safra, Fazenda, Cultivar), numa só passada agrupada.
+
+    Produtividade e umidade viram médias das parcelas, com `Parcelas` (número) e
+    `Variancia_sc_ha` (variância amostral da produtividade; NaN com uma parcela). As
+    demais colunas vêm da primeira parcela. Os grupos ficam na ordem em que aparecem.
+    """
+    chaves = [col for col in COLUNAS_REPETICAO if col in df.columns]
+    medias = [col for col in COLUNAS_MEDIA if col in df.columns]
+    agregacoes = {col: (col, "mean" if col in medias else "first") for col in df.columns if col not in chaves}
+    agregado = df.groupby(chaves, sort=False, observed=True, dropna=False).agg(
+        **agregacoes,
+        Parcelas=("prod_sc_ha", "count"),
+        Variancia_sc_ha=("prod_sc_ha", "var")
+    )
+    return agregado.reset_index()[list(df.columns) + ["Parcelas", "Variancia_sc_ha"]]
+
+
+def ler_excel(fonte):
+    """Lê a primeira planilha em modo streaming, só com as colunas usadas e já tipadas.
+
+    O cabeçalho é validado antes de qualquer linha de dados ser lida. Cada bloco de
+    linhas já sai com as colunas de rótulo categóricas.
+    """
+    try:
+        wb = openpyxl.load_workbook(fonte, read_only=True, data_only=True)
+    except (InvalidFileException, zipfile.BadZipFile) as erro:
+        raise ErroIngestao(f"Arquivo Excel inválido: {erro}") from erro
+
+    try:
+        planilha = wb.worksheets[0]
+        # Alguns exportadores gravam uma dimensão desatualizada, que cortaria as linhas
+        planilha.reset_dimensions()
+        linhas = planilha.iter_rows(values_only=True)
+        cabecalho = next(linhas, None) or ()
+
+        # Primeira ocorrência de cada coluna necessária, já com o nome final
+        posicoes = {}
+        for i, nome in enumerate(cabecalho):
+            nome = RENOMEAR_COLUNAS.get(nome, nome)
+            if nome in COLUNAS_NECESSARIAS and nome not in posicoes:
+                posicoes[nome] = i
+
+        faltando = [col for col in COLUNAS_OBRIGATORIAS if col not in posicoes]
+        if faltando:
+            raise ErroIngestao(f"Colunas obrigatórias ausentes: {', '.join(faltando)}")
+
+        nomes = [col for col in COLUNAS_NECESSARIAS if col in posicoes]
+        indices = [posicoes[col] for col in nomes]
+        largura = max(indices) + 1
+
+        partes = []
+        bloco = []
+        for linha in linhas:
+            if len(linha) < largura:
+                linha = linha + (None,) * (largura - len(linha))
+            bloco.append([linha[i] for i in indices])
+            if len(bloco) == LINHAS_POR_BLOCO:
+                partes.append(_categorizar(_limpar(pd.DataFrame.from_records(bloco, columns=nomes))))
+                bloco = []
+        if bloco or not partes:
+            partes.append(_categorizar(_limpar(pd.DataFrame.from_records(bloco, columns=nomes))))
+    finally:
+        wb.close()
+
+    return _juntar_blocos(partes)
+
+
+class IndiceFiltros:
+    """Dados do ensaio com índice invertido (valor -> linhas) para cada coluna de filtro.
+
+    As seleções viram máscaras booleanas combinadas com `&`; o DataFrame filtrado
+    só é materializado uma vez, em `filtrar`. Uma máscara `None` significa todas as linhas.
+    Linhas sem valor (na base, de planilhas sem a coluna) aparecem como a opção None
+    e ficam em qualquer faixa.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self._codigos = {}
+        self._valores = {}
+        self._posicao_valor = {}
+        self._linhas = {}
+        self._inicio = {}
+        self._faltantes = {}
+
+        for coluna in COLUNAS_FILTRO:
+            if coluna not in df.columns:
+                continue
+            codigos, valores = pd.factorize(df[coluna])
+            self._codigos[coluna] = codigos.astype(np.int32)
+            self._valores[coluna] = np.asarray(valores)
+            self._posicao_valor[coluna] = {valor: i for i, valor in enumerate(self._valores[coluna].tolist())}
+
+            # Linhas de cada valor, contíguas; faltantes (-1) ficam de fora
+            ordem = np.argsort(codigos, kind="stable")
+            self._linhas[coluna] = ordem[codigos[ordem] >= 0].astype(np.int32)
+            self._inicio[coluna] = np.concatenate([[0], np.cumsum(np.bincount(codigos[codigos >= 0], minlength=len(valores)))])
+            self._faltantes[coluna] = np.flatnonzero(codigos < 0).astype(np.int32)
+
+        # Colunas de faixa: linhas ordenadas pelo valor, para busca binária
+        for coluna in COLUNAS_FAIXA:
+            if coluna not in df.columns:
+                continue
+            valores = df[coluna].to_numpy(dtype=float)
+            ordem = np.argsort(valores, kind="stable")
+            self._linhas[coluna] = ordem.astype(np.int32)
+            self._valores[coluna] = valores[ordem]
+            self._faltantes[coluna] = np.flatnonzero(np.isnan(valores)).astype(np.int32)
+
+    def tamanho(self):
+        """Memória aproximada (bytes) dos dados e do índice."""
+        return _tamanho_df(self.df) + sum(
+            arr.nbytes for grupo in (self._codigos, self._linhas, self._inicio, self._faltantes) for arr in grupo.values()
+        )
+
+    def opcoes(self, coluna, mascara=None):
+        """Valores da coluna presentes nas linhas da máscara, na ordem em que aparecem; None por último."""
+        codigos = self._codigos[coluna] if mascara is None else self._codigos[coluna][mascara]
+        presentes = pd.unique(codigos[codigos >= 0])
+        return self._valores[coluna][presentes].tolist() + ([None] if (codigos < 0).any() else [])
+
+    def restringir(self, mascara, coluna, selecionados):
+        """Máscara com as linhas cuja coluna está entre os valores selecionados."""
+        linhas, inicio = self._linhas[coluna], self._inicio[coluna]
+        posicoes = [self._posicao_valor[coluna][valor] for valor in selecionados if valor in self._posicao_valor[coluna]]
+        selecao = np.zeros(len(self.df), dtype=bool)
+        for i in posicoes:
+            selecao[linhas[inicio[i]:inicio[i + 1]]] = True
+        if None in selecionados:
+            selecao[self._faltantes[coluna]] = True
+        return selecao if mascara is None else mascara & selecao
+
+    def faixa(self, coluna, mascara=None):
+        """(mínimo, máximo) da coluna nas linhas da máscara, ou None se não houver linhas."""
+        valores = self.df[coluna].to_numpy(dtype=float)
+        if mascara is not None:
+            valores = valores[mascara]
+        valores = valores[~np.isnan(valores)]
+        if not valores.size:
+            return None
+        return valores.min(), valores.max()
+
+    def restringir_faixa(self, mascara, coluna, minimo, maximo):
+        """Máscara com as linhas cuja coluna está entre `minimo` e `maximo` (inclusive) ou sem valor."""
+        inicio = np.searchsorted(self._valores[coluna], minimo, side="left")
+        fim = np.searchsorted(self._valores[coluna], maximo, side="right")
+        selecao = np.zeros(len(self.df), dtype=bool)
+        selecao[self._linhas[coluna][inicio:fim]] = True
+        selecao[self._faltantes[coluna]] = True
+        return selecao if mascara is None else mascara & selecao
+
+    def filtrar(self, mascara=None):
+        """DataFrame com as linhas da máscara."""
+        return self.df if mascara is None else self.df[mascara]
+
+
+def carregar_excel(conteudo):
+    """Lê, normaliza e indexa um Excel a partir dos bytes, com cache pelo hash do conteúdo.
+
+    Devolve um `IndiceFiltros`; ele e seu DataFrame são compartilhados entre sessões
+    e não devem ser alterados in-place.
+    """
+    chave = hashlib.sha256(conteudo).hexdigest()
+
+    with _trava_ingestao:
+        dados = _cache_ingestao.get(chave)
+        if dados is not None:
+            return dados
+        trava_arquivo = _travas_arquivo.setdefault(chave, threading.Lock())
+
+    # Sessões abrindo o mesmo arquivo ao mesmo tempo esperam uma única leitura
+    try:
+        with trava_arquivo:
+            with _trava_ingestao:
+                dados = _cache_ingestao.get(chave)
+            if dados is None:
+                dados = IndiceFiltros(ler_excel(io.BytesIO(conteudo)))
+                with _trava_ingestao:
+                    try:
+                        _cache_ingestao[chave] = dados
+                    except ValueError:
+                        # Arquivo maior que o orçamento inteiro do cache
+                        pass
+    finally:
+        # Também quando a leitura falha, para não acumular travas de arquivos inválidos
+        with _trava_ingestao:
+            _travas_arquivo.pop(chave, None)
+    return dados
+
+
+# Base local de ensaios em Parquet, acumulando vários Excel (diretório em H2H_DATASET)
+DIRETORIO_DATASET = config("H2H_DATASET", default="dados_h2h")
+COLUNAS_PARTICAO = ["Safra", "Estado"]
+
+# Tipos fixos para que arquivos de origens diferentes formem um único dataset
+ESQUEMA_DATASET = pa.schema([
+    (col, pa.string() if col in COLUNAS_CATEGORICAS
+     else pa.timestamp("ms") if col in ("Plantio", "Colheita")
+     else pa.float64())
+    for col in COLUNAS_NECESSARIAS
+])
+
+
+def _particionamento():
+    return ds.partitioning(pa.schema([ESQUEMA_DATASET.field(col) for col in COLUNAS_PARTICAO]), flavor="hive")
+
+
+def _tabela_dataset(df):
+    """DataFrame normalizado convertido para o esquema da base; colunas ausentes ficam nulas."""
+    colunas = {}
+    for campo in ESQUEMA_DATASET:
+        serie = df[campo.name] if campo.name in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if pa.types.is_string(campo.type):
+            colunas[campo.name] = serie.astype("string")
+        elif pa.types.is_timestamp(campo.type):
+            colunas[campo.name] = pd.to_datetime(serie, errors="coerce")
+        else:
+            colunas[campo.name] = pd.to_numeric(serie, errors="coerce")
+    return pa.Table.from_pandas(pd.DataFrame(colunas), schema=ESQUEMA_DATASET, preserve_index=False)
+
+
+def adicionar_dataset(conteudo, raiz=DIRETORIO_DATASET):
+    """Acrescenta um Excel (bytes) à base Parquet, particionada por COLUNAS_PARTICAO.
+
+    Os arquivos levam o hash do conteúdo no nome: reenviar a mesma planilha
+    sobrescreve os mesmos arquivos em vez de duplicar linhas. Devolve o número de linhas.
+    """
+    chave = hashlib.sha256(conteudo).hexdigest()
+    df = carregar_excel(conteudo).df
+    ds.write_dataset(
+        _tabela_dataset(df), raiz, format="parquet",
+        partitioning=_particionamento(),
+        basename_template=f"{chave[:16]}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore"
+    )
+    return len(df)
+
+
+def _abrir_dataset(raiz):
+    """Dataset da base com arquivos mapeados em memória, ou None se a base ainda não existe."""
+    sistema = fs.LocalFileSystem(use_mmap=True)
+    if sistema.get_file_info(raiz).type != fs.FileType.Directory:
+        return None
+    return ds.dataset(raiz, schema=ESQUEMA_DATASET, format="parquet", partitioning=_particionamento(), filesystem=sistema)
+
+
+def _ordenar_valores(valores):
+    """Valores de partição ordenados; None (planilhas sem a coluna) vai por último."""
+    return sorted(valores, key=lambda valor: (valor is None, "" if valor is None else valor))
+
+
+def particoes_dataset(raiz=DIRETORIO_DATASET):
+    """Valores de cada coluna de partição presentes na base, só pela estrutura de diretórios.
+
+    Linhas sem valor na coluna ficam na partição nula e aparecem como None.
+    """
+    valores = {col: set() for col in COLUNAS_PARTICAO}
+    dataset = _abrir_dataset(raiz)
+    if dataset is not None:
+        for fragmento in dataset.get_fragments():
+            for col, valor in ds.get_partition_keys(fragmento.partition_expression).items():
+                valores[col].add(valor)
+    return {col: _ordenar_valores(v) for col, v in valores.items()}
+
+
+def carregar_dataset(filtros=None, raiz=DIRETORIO_DATASET):
+    """Lê da base só as linhas selecionadas e devolve um `IndiceFiltros`, com cache.
+
+    `filtros` mapeia coluna -> valores aceitos. Nas colunas de partição o filtro
+    descarta diretórios inteiros; nas demais vira predicado na leitura dos arquivos.
+    """
+    dataset = _abrir_dataset(raiz)
+    if dataset is None:
+        return None
+
+    filtros = {col: tuple(_ordenar_valores(valores)) for col, valores in (filtros or {}).items() if valores is not None}
+    expressao = None
+    for col, valores in filtros.items():
+        presentes = [valor for valor in valores if valor is not None]
+        condicao = ds.field(col).isin(pa.array(presentes, type=ESQUEMA_DATASET.field(col).type))
+        # None seleciona a partição nula, que isin não alcança
+        if len(presentes) < len(valores):
+            condicao = condicao | ds.field(col).is_null()
+        expressao = condicao if expressao is None else expressao & condicao
+
+    # Novos arquivos na base mudam a chave
+    chave = ("dataset", raiz, tuple(sorted(dataset.files)), tuple(sorted(filtros.items())))
+    with _trava_ingestao:
+        dados = _cache_ingestao.get(chave)
+    if dados is not None:
+        return dados
+
+    df = dataset.to_table(filter=expressao).to_pandas()
+    # Colunas que nenhuma planilha trazia não entram na análise
+    if len(df):
+        df = df.drop(columns=df.columns[df.isna().all()])
+    df = _categorizar(df)
+    dados = IndiceFiltros(df)
+    with _trava_ingestao:
+        try:
+            _cache_ingestao[chave] = dados
+        except ValueError:
+            pass
+    return dados
+
+
+FORMATOS_EXPORTACAO = {
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet")
+}
+
+# Acima deste número de células o xlsx é escrito linha a linha, com memória constante
+CELULAS_XLSX_STREAMING = 1_000_000
+
+# Linhas por página nas tabelas (padrão, ajustável na barra lateral)
+LINHAS_POR_PAGINA = config("H2H_LINHAS_POR_PAGINA", default=100, cast=int)
+
+# Limite de linhas de dados por aba do Excel (a primeira linha é o cabeçalho)
+LINHAS_POR_ABA = 1_048_575
+
+# Arquivos exportados, por conteúdo e formato. Orçamento (MB) em H2H_CACHE_EXPORTACAO_MB.
+_cache_exportacao = LRUCache(maxsize=config("H2H_CACHE_EXPORTACAO_MB", default=256, cast=int) * 1024 ** 2, getsizeof=len)
+_trava_exportacao = threading.Lock()
+
+
+def assinatura_df(df):
+    """Hash do conteúdo (colunas e valores) de um DataFrame."""
+    hash_linhas = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.sha256(repr(list(df.columns)).encode() + hash_linhas.tobytes()).hexdigest()
+
+
+def _nome_aba(nome, usados):
+    """Nome de aba válido no Excel (até 31 caracteres, sem []:*?/\\) e ainda não usado no arquivo."""
+    base = re.sub(r"[\[\]:*?/\\]", "_", str(nome))[:31] or "Aba"
+    nome, n = base, 1
+    while nome.lower() in usados:
+        n += 1
+        nome = f"{base[:31 - len(str(n)) - 3]} ({n})"
+    usados.add(nome.lower())
+    return nome
+
+
+def _escrever_abas(wb, nome_aba, df, formato_cabecalho, usados, titulo=None):
+    """Escreve o DataFrame linha a linha, continuando em novas abas se passar do limite do Excel.
+
+    `titulo` é um par (texto, formato) escrito acima da tabela. Devolve a primeira aba.
+    Em `constant_memory` as linhas de cada aba precisam sair em ordem.
+    """
+    colunas = [str(col) for col in df.columns]
+    linha_inicial = 0 if titulo is None else 2
+    abas = []
+    for inicio in range(0, max(len(df), 1), LINHAS_POR_ABA - linha_inicial):
+        ws = wb.add_worksheet(_nome_aba(nome_aba, usados))
+        if titulo is not None:
+            ws.write(0, 0, *titulo)
+        ws.write_row(linha_inicial, 0, colunas, formato_cabecalho)
+        trecho = df.iloc[inicio:inicio + LINHAS_POR_ABA - linha_inicial]
+        for linha, valores in enumerate(trecho.itertuples(index=False, name=None), start=linha_inicial + 1):
+            ws.write_row(linha, 0, [None if pd.isna(valor) else valor for valor in valores])
+        abas.append(ws)
+    return abas[0]
+
+
+def _excel_streaming(df, buffer, nome_aba):
+    """Escreve o xlsx linha a linha (constant_memory), dividindo em abas se passar do limite do Excel."""
+    wb = xlsxwriter.Workbook(buffer, {
+        "constant_memory": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss"
+    })
+    negrito = wb.add_format({"bold": True, "border": 1, "align": "center"})
+    _escrever_abas(wb, nome_aba, df, negrito, set())
+    wb.close()
+
+
+def exportar(df, formato, nome_aba="Planilha", assinatura=None):
+    """Bytes do DataFrame no formato pedido (ver FORMATOS_EXPORTACAO), memorizados pelo conteúdo."""
+    chave = (assinatura or assinatura_df(df), formato, nome_aba)
+    with _trava_exportacao:
+        dados = _cache_exportacao.get(chave)
+    if dados is not None:
+        return dados
+
+    buffer = io.BytesIO()
+    if formato == "CSV":
+        df.to_csv(buffer, index=False)
+    elif formato == "Parquet":
+        df.to_parquet(buffer, index=False)
+    elif df.size > CELULAS_XLSX_STREAMING:
+        _excel_streaming(df, buffer, nome_aba)
+    else:
+        with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+            df.to_excel(writer, index=False, sheet_name=nome_aba)
+    dados = buffer.getvalue()
+
+    with _trava_exportacao:
+        try:
+            _cache_exportacao[chave] = dados
+        except ValueError:
+            pass
+    return dados
+
+
+def _mascara_filtro(serie, texto):
+    """Linhas da série que atendem ao filtro de texto.
+
+    Colunas numéricas aceitam uma comparação (`>1`, `<=-2.5`, `=60`); as demais,
+    um trecho de texto (sem diferenciar maiúsculas).
+    """
+    texto = texto.strip()
+    if pd.api.types.is_numeric_dtype(serie):
+        comparacao = re.fullmatch(r"(>=|<=|>|<|=)?\s*(-?\d+(?:[.,]\d+)?)", texto)
+        if comparacao is None:
+            raise ValueError(f"Filtro numérico inválido: {texto!r}")
+        operador, numero = comparacao.group(1) or "=", float(comparacao.group(2).replace(",", "."))
+        return {
+            ">=": serie >= numero, "<=": serie <= numero, ">": serie > numero,
+            "<": serie < numero, "=": serie == numero
+        }[operador].to_numpy()
+
+    # Compara só os valores distintos e propaga pelos códigos
+    codigos, unicos = pd.factorize(serie)
+    contem = pd.Index(unicos).astype(str).str.contains(texto, case=False, regex=False)
+    return np.append(np.asarray(contem, dtype=bool), False)[codigos]
+
+
+def paginar(df, pagina, tamanho, ordenar_por=None, crescente=True, filtro=None):
+    """Página `pagina` (a partir de 1) do DataFrame, depois do filtro e da ordenação.
+
+    `filtro` é um par (coluna, texto), ver `_mascara_filtro`. Devolve a fatia e o
+    total de linhas que passaram no filtro.
+    """
+    if filtro is not None and filtro[1].strip():
+        df = df[_mascara_filtro(df[filtro[0]], filtro[1])]
+    if ordenar_por is not None:
+        df = df.sort_values(ordenar_por, ascending=crescente, kind="stable")
+    inicio = (pagina - 1) * tamanho
+    return df.iloc[inicio:inicio + tamanho], len(df)
+
+
+def _indices_pares(tamanhos):
+    """Índices (head, check) de todos os pares ordenados dentro de cada bloco contíguo de linhas."""
+    tamanhos = np.asarray(tamanhos, dtype=np.int64)
+    inicio_bloco = np.cumsum(tamanhos) - tamanhos
+
+    # Cada linha do bloco vira head uma vez para cada linha do mesmo bloco
+    n_por_linha = np.repeat(tamanhos, tamanhos)
+    head = np.repeat(np.arange(n_por_linha.size), n_por_linha)
+
+    inicio_head = np.cumsum(n_por_linha) - n_por_linha
+    deslocamento = np.arange(head.size) - np.repeat(inicio_head, n_por_linha)
+    check = np.repeat(np.repeat(inicio_bloco, tamanhos), n_por_linha) + deslocamento
+
+    mantem = head != check
+    return head[mantem], check[mantem]
+
+
+def calcular_h2h(df):
+    """Tabela Head to Head de todos os pares de cultivares dentro de cada Fazenda.
+
+    Reproduz o laço por fazenda: locais (Fazenda e Safra) em ordem, cultivares na ordem
+    em que aparecem e, havendo repetição, a média das parcelas (ver `agregar_repeticoes`).
+    """
+    return ResultadoH2H(df).tabela()
+
+
+def _com_medias(totais, arredondar=False):
+    """Acrescenta diferença média e médias de head e check (sc/ha) aos totais inteiros.
+
+    Com `arredondar`, as médias saem arredondadas a 0,1 a partir das somas exatas, e
+    entra também o % de vitórias.
+    """
+    n = totais["Num_Locais"]
+    if arredondar:
+        totais["Diferenca_Media"] = np.rint((totais["Soma_Head"] - totais["Soma_Check"]) / n) / 10
+        totais["Head_Mean"] = np.rint(totais["Soma_Head"] / n) / 10
+        totais["Check_Mean"] = np.rint(totais["Soma_Check"] / n) / 10
+        totais["% Vitórias"] = (totais["Vitorias"] / n * 100).round(1)
+    else:
+        totais["Diferenca_Media"] = (totais["Soma_Head"] - totais["Soma_Check"]) / (10 * n)
+        totais["Head_Mean"] = totais["Soma_Head"] / (10 * n)
+        totais["Check_Mean"] = totais["Soma_Check"] / (10 * n)
+    return totais
+
+
+def _quantis(valores, quantis):
+    """Quantis de cada coluna ignorando NaN (interpolação linear, como np.nanquantile, mas bem mais rápido)."""
+    ordenado = np.sort(valores, axis=0)
+    validos = np.count_nonzero(~np.isnan(valores), axis=0)
+    colunas = np.arange(valores.shape[1])
+    saida = []
+    for q in quantis:
+        posicao = q * np.maximum(validos - 1, 0)
+        baixo = np.floor(posicao).astype(np.int64)
+        alto = np.minimum(baixo + 1, np.maximum(validos - 1, 0))
+        fracao = posicao - baixo
+        valor = ordenado[baixo, colunas] * (1 - fracao) + ordenado[alto, colunas] * fracao
+        saida.append(np.where(validos > 0, valor, np.nan))
+    return np.array(saida)
+
+
+# Totais inteiros de cada par; produtividades somadas em décimos de sc/ha
+COLUNAS_TOTAIS = ["Num_Locais", "Vitorias", "Empates", "Derrotas", "Soma_Head", "Soma_Check"]
+
+# Níveis de agregação acima do local (Fazenda e Safra), do mais amplo ao mais fino
+NIVEIS_HIERARQUIA = ["Safra", "Estado", "Microrregiao", "Cidade"]
+
+# Até este número de chaves (grupo x head x check) as agregações usam contagem densa
+CHAVES_DENSAS = 8_000_000
+
+# Intervalos de confiança bootstrap (reamostragens padrão e nível)
+REAMOSTRAGENS = config("H2H_REAMOSTRAGENS", default=1000, cast=int)
+CONFIANCA = 0.95
+COLUNAS_INTERVALOS = ["Dif_IC_Inf", "Dif_IC_Sup", "Vit_IC_Inf", "Vit_IC_Sup"]
+
+# Elementos (reamostragens x pares, fazendas x pares) por multiplicação de matrizes no bootstrap
+ELEMENTOS_POR_BLOCO = 4_000_000
+
+# Margem de empate: |diferença| <= margem é empate. Em sc/ha ou, relativa, em % da produtividade do check
+LIMIAR_EMPATE = config("H2H_LIMIAR_EMPATE", default=1.0, cast=float)
+
+# Margens da varredura de % de vitórias: em sc/ha e em % do check
+LIMIARES_VARREDURA = {False: np.round(np.arange(0, 5.01, 0.1), 2), True: np.round(np.arange(0, 10.01, 0.25), 2)}
+
+# Reclassificações (por margem) guardadas em cada resultado
+RECLASSIFICACOES_GUARDADAS = 8
+
+# Ranking Bradley-Terry: jogos fictícios contra um cultivar de força 1 (1 vitória e 1 derrota),
+# que mantêm finitas as forças de quem só ganhou ou só perdeu; e critério de parada
+JOGOS_PRIORI = 1.0
+ITERACOES_RANKING = 100
+TOLERANCIA_RANKING = 1e-6
+
+# Processos do modo paralelo (padrão: todos os núcleos) e blocos de fazendas por processo
+PROCESSOS = config("H2H_PROCESSOS", default=os.cpu_count() or 1, cast=int)
+BLOCOS_POR_PROCESSO = 4
+
+_pool = None
+_trava_pool = threading.Lock()
+
+
+def _classificar(dif, check, limiar, relativo=False, escala=1):
+    """1 (vitória do head), 0 (empate) ou -1 (derrota) de cada comparação.
+
+    `dif` e `check` estão na mesma unidade, `escala` vezes sc/ha (10 para décimos); a
+    escala só afeta a margem absoluta. Com `limiar` em forma (k, 1), classifica com as
+    k margens de uma vez.
+    """
+    limiar = np.asarray(limiar, dtype=np.float64)
+    margem = check * (limiar / 100) if relativo else np.round(limiar * escala, 6)
+    return (dif > margem).astype(np.int8) - (dif < -margem)
+
+
+def _logistica(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def _forcas_bradley_terry(head, check, jogos, vitorias, n):
+    """Log-forças de Bradley-Terry dos `n` cultivares, por Newton com gradiente conjugado.
+
+    Os pares (head, check) vêm nos dois sentidos, com `jogos` comparações e `vitorias`
+    do head. A hessiana (um laplaciano ponderado do grafo de pares mais a diagonal
+    dos jogos fictícios) não é montada: os produtos por ela saem de `np.bincount` sobre
+    os pares, então o custo de cada iteração é proporcional ao número de pares.
+    """
+    ganhos = np.bincount(head, weights=vitorias, minlength=n) + JOGOS_PRIORI
+
+    def log_verossimilhanca(theta):
+        return (ganhos @ theta - (jogos * np.logaddexp(theta[head], theta[check])).sum() / 2
+                - 2 * JOGOS_PRIORI * np.logaddexp(theta, 0).sum())
+
+    theta = np.zeros(n)
+    atual = log_verossimilhanca(theta)
+    for _ in range(ITERACOES_RANKING):
+        q = _logistica(theta[head] - theta[check])
+        s = _logistica(theta)
+        gradiente = ganhos - np.bincount(head, weights=jogos * q, minlength=n) - 2 * JOGOS_PRIORI * s
+        if np.max(np.abs(gradiente)) < TOLERANCIA_RANKING:
+            break
+
+        peso = jogos * q * (1 - q)
+        diagonal = np.bincount(head, weights=peso, minlength=n) + 2 * JOGOS_PRIORI * s * (1 - s)
+
+        def hessiana(v):
+            return diagonal * v - np.bincount(head, weights=peso * v[check], minlength=n)
+
+        # Gradiente conjugado (pré-condicionado pela diagonal) para hessiana @ passo = gradiente
+        passo = np.zeros(n)
+        residuo = gradiente.copy()
+        z = residuo / diagonal
+        direcao = z.copy()
+        rz = residuo @ z
+        for _ in range(n):
+            hd = hessiana(direcao)
+            alfa = rz / (direcao @ hd)
+            passo += alfa * direcao
+            residuo -= alfa * hd
+            if np.max(np.abs(residuo)) < TOLERANCIA_RANKING / 10:
+                break
+            z = residuo / diagonal
+            rz, rz_anterior = residuo @ z, rz
+            direcao = z + (rz / rz_anterior) * direcao
+
+        # Passo de Newton reduzido até a verossimilhança (côncava) não diminuir
+        tamanho = 1.0
+        while tamanho > 1e-8:
+            nova = log_verossimilhanca(theta + tamanho * passo)
+            if nova >= atual:
+                break
+            tamanho /= 2
+        theta, atual = theta + tamanho * passo, nova
+    return theta
+
+
+def _obter_pool(processos):
+    """Pool de processos reaproveitado entre execuções (recriado se mudar o número de processos)."""
+    global _pool
+    with _trava_pool:
+        if _pool is None or _pool._max_workers != processos:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn: não herda as threads do servidor, e funciona igual no Windows
+            _pool = ProcessPoolExecutor(max_workers=processos, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _compartilhar(arrays):
+    """Copia os arrays para blocos de memória compartilhada; devolve os blocos e as descrições."""
+    blocos, descricoes = [], {}
+    for nome, array in arrays.items():
+        bloco = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=bloco.buf)[...] = array
+        blocos.append(bloco)
+        descricoes[nome] = (bloco.name, array.shape, array.dtype.str)
+    return blocos, descricoes
+
+
+def _somar_bloco(descricoes, n_cultivares, limiar, fazendas):
+    """Totais dos pares de um bloco de fazendas, num processo do pool, lendo os arrays compartilhados."""
+    blocos, arrays = [], {}
+    try:
+        for nome, (nome_bloco, forma, tipo) in descricoes.items():
+            # Os processos do pool usam o resource tracker do principal, que remove os blocos
+            bloco = shared_memory.SharedMemory(name=nome_bloco)
+            blocos.append(bloco)
+            arrays[nome] = np.ndarray(forma, np.dtype(tipo), buffer=bloco.buf)
+        parcial = ResultadoH2H._de_arrays(n_cultivares=n_cultivares, limiar=limiar, **arrays)
+        return parcial._somar_pares(*parcial._pares_fazendas(fazendas))
+    finally:
+        arrays.clear()
+        for bloco in blocos:
+            bloco.close()
+
+
+class ResultadoH2H:
+    """Resultado Head to Head compacto, indexado por par (head, check).
+
+    Os pares são feitos por local (Fazenda e Safra) sobre `agregar_repeticoes`: as
+    parcelas repetidas de um cultivar no local entram pela média. Guarda só uma linha
+    por local/Cultivar (códigos inteiros e produtividade) e os totais de cada par; a
+    tabela por local e suas colunas derivadas são montadas sob demanda, para exibição
+    ou exportação.
+
+    Com `anterior` (o resultado de uma execução anterior), os totais são atualizados
+    a partir dos dele: só os pares que envolvem uma linha Fazenda/Cultivar que saiu,
+    entrou ou mudou de produtividade são recalculados.
+
+    Sem `anterior` e com `processos` > 1, os pares são somados em paralelo por blocos
+    de fazendas; os totais são inteiros, então o resultado é idêntico ao serial.
+    `progresso(feitos, total)` é chamado a cada bloco concluído.
+
+    Vitória, empate e derrota usam a margem `limiar` (sc/ha ou, com `relativo`, % do
+    check); `reclassificar` troca a margem sem gerar os pares de novo.
+    """
+
+    def __init__(self, df, anterior=None, processos=1, progresso=None, limiar=LIMIAR_EMPATE, relativo=False):
+        colunas_locais = [col for col in NIVEIS_HIERARQUIA if col in df.columns]
+        base = agregar_repeticoes(df[list(dict.fromkeys(["Fazenda", "Cultivar", "prod_sc_ha"] + colunas_locais))])
+
+        # Local = Fazenda e Safra, em ordem de fazenda e, dentro dela, de safra
+        cod_fazenda = pd.factorize(base["Fazenda"], sort=True)[0].astype(np.int64)
+        if "Safra" in base.columns:
+            cod_safra, safras = pd.factorize(base["Safra"], sort=True, use_na_sentinel=False)
+            cod_fazenda = cod_fazenda * len(safras) + cod_safra
+        cod_fazenda = pd.factorize(cod_fazenda, sort=True)[0]
+        cod_cultivar, cultivares = pd.factorize(base["Cultivar"], sort=True)
+        ordem = np.argsort(cod_fazenda, kind="stable")
+        tamanhos = np.bincount(cod_fazenda)
+        primeira = ordem[np.concatenate([[0], np.cumsum(tamanhos)[:-1]])] if len(base) else ordem
+
+        self._fazendas = base["Fazenda"].to_numpy(dtype=object)[primeira]
+        self._safras = base["Safra"].to_numpy(dtype=object)[primeira] if "Safra" in base.columns else None
+        self._rotulos = np.asarray(cultivares)
+        self._codigos = {rotulo: i for i, rotulo in enumerate(self._rotulos.tolist())}
+
+        # Safra, Estado, ... de cada local (da primeira linha dele), para as agregações
+        self._locais = base[colunas_locais].iloc[primeira].astype(object).reset_index(drop=True)
+        self._agregados = None
+        self.limiar = (float(limiar), bool(relativo))
+
+        # Uma linha por local/Cultivar: locais em ordem, cultivares na ordem em que aparecem
+        self._fazenda = cod_fazenda[ordem].astype(np.int32)
+        self._cultivar = cod_cultivar[ordem].astype(np.int32)
+        self._prod = base["prod_sc_ha"].to_numpy()[ordem]
+        self._tamanhos = tamanhos.astype(np.int32)
+        self._inicio = np.concatenate([[0], np.cumsum(tamanhos)])
+        self._inicio_pares = np.concatenate([[0], np.cumsum(tamanhos * (tamanhos - 1))])
+
+        # Lista invertida: linhas de cada cultivar, em ordem de fazenda
+        self._linhas_cultivar = np.argsort(self._cultivar, kind="stable").astype(np.int32)
+        self._inicio_cultivar = np.concatenate([[0], np.cumsum(np.bincount(self._cultivar, minlength=len(self._rotulos)))])
+
+        com_par = np.unique(self._cultivar[self._tamanhos[self._fazenda] > 1])
+        self.cultivares = sorted(self._rotulos[com_par])
+
+        # Hash de cada linha (local, cultivar, produtividade), para comparar execuções
+        hash_locais = pd.util.hash_array(self._fazendas)
+        if self._safras is not None:
+            hash_locais = hash_locais ^ pd.util.hash_array(self._safras.astype(str)) * np.uint64(0x94D049BB133111EB)
+        self._hash_linhas = (
+            hash_locais[self._fazenda] * np.uint64(0x9E3779B97F4A7C15)
+            + pd.util.hash_array(self._rotulos)[self._cultivar] * np.uint64(0xBF58476D1CE4E5B9)
+            + pd.util.hash_array(self._prod)
+        )
+
+        if anterior is None and processos > 1 and len(self._fazendas) >= 2 * processos:
+            totais = self._somar_paralelo(processos, progresso)
+        elif anterior is None:
+            totais = self._somar_pares(*self._pares_fazendas(np.arange(len(self._fazendas))))
+        else:
+            totais = self._atualizar(anterior)
+
+        self._chaves = np.flatnonzero(totais[0])
+        totais = totais[:, self._chaves]
+        head, check = np.divmod(self._chaves, len(self._rotulos))
+        self.totais = _com_medias(pd.DataFrame(
+            dict(zip(COLUNAS_TOTAIS, totais)),
+            index=pd.MultiIndex.from_arrays([self._rotulos[head], self._rotulos[check]], names=["Head", "Check"])
+        ))
+
+        # Intervalos já calculados, por (reamostragens, confiança, semente)
+        self._intervalos = {}
+
+        # Comparações em décimos (ver `_comparacoes`) e resultados com outras margens
+        self._cache_comparacoes = None
+        self._reclassificados = LRUCache(maxsize=RECLASSIFICACOES_GUARDADAS)
+        self._ranking = None
+
+    @classmethod
+    def _de_arrays(cls, cultivar, prod, tamanhos, inicio, n_cultivares, limiar):
+        """Resultado parcial, só com o necessário para somar pares (usado nos processos do pool)."""
+        parcial = cls.__new__(cls)
+        parcial._cultivar, parcial._prod, parcial._tamanhos, parcial._inicio = cultivar, prod, tamanhos, inicio
+        parcial._rotulos = np.arange(n_cultivares)
+        parcial.limiar = limiar
+        return parcial
+
+    def _somar_paralelo(self, processos, progresso=None):
+        """Totais de todos os pares, somados em blocos de fazendas num pool de processos."""
+        # Blocos com números parecidos de pares (n * (n - 1) por fazenda), não de fazendas
+        pares = np.cumsum(self._tamanhos.astype(np.int64) * (self._tamanhos - 1))
+        n_blocos = min(processos * BLOCOS_POR_PROCESSO, len(self._fazendas))
+        cortes = np.searchsorted(pares, np.linspace(0, pares[-1], n_blocos + 1)[1:-1], side="right")
+        blocos_fazendas = [bloco for bloco in np.split(np.arange(len(self._fazendas)), cortes) if bloco.size]
+
+        blocos, descricoes = _compartilhar({
+            "cultivar": self._cultivar, "prod": self._prod, "tamanhos": self._tamanhos, "inicio": self._inicio
+        })
+        try:
+            pool = _obter_pool(processos)
+            futuros = [pool.submit(_somar_bloco, descricoes, len(self._rotulos), self.limiar, bloco) for bloco in blocos_fazendas]
+            totais = np.zeros((len(COLUNAS_TOTAIS), len(self._rotulos) ** 2), dtype=np.int64)
+            for feitos, futuro in enumerate(as_completed(futuros), start=1):
+                totais += futuro.result()
+                if progresso is not None:
+                    progresso(feitos, len(futuros))
+        finally:
+            for bloco in blocos:
+                bloco.close()
+                bloco.unlink()
+        return totais
+
+    def _pares_fazendas(self, fazendas):
+        """Pares (head, check) de linhas-base dentro das fazendas informadas (códigos)."""
+        tamanhos = self._tamanhos[fazendas]
+        head, check = _indices_pares(tamanhos)
+        inicio_local = np.cumsum(tamanhos) - tamanhos
+        linhas = np.arange(tamanhos.sum()) + np.repeat(self._inicio[fazendas] - inicio_local, tamanhos)
+        return linhas[head], linhas[check]
+
+    def _pares_linhas(self, mudou):
+        """Pares (head, check) de linhas-base em que ao menos uma das linhas está marcada em `mudou`."""
+        linhas = np.flatnonzero(mudou)
+        fazenda = self._fazenda[linhas]
+        tamanhos = self._tamanhos[fazenda]
+        linha = np.repeat(linhas, tamanhos)
+        outra = np.repeat(self._inicio[fazenda], tamanhos) + np.arange(tamanhos.sum()) - np.repeat(np.cumsum(tamanhos) - tamanhos, tamanhos)
+        diferentes = linha != outra
+        linha, outra = linha[diferentes], outra[diferentes]
+
+        # Par entre duas linhas marcadas aparece pelos dois lados; o inverso só entra uma vez
+        so_um = ~mudou[outra]
+        return np.concatenate([linha, outra[so_um]]), np.concatenate([outra, linha[so_um]])
+
+    def _somar_pares(self, head, check, codigos=None, n_cultivares=None):
+        """Totais (COLUNAS_TOTAIS x pares) dos pares de linhas-base, em matriz densa por head * C + check.
+
+        `codigos` traduz os códigos de cultivar deste resultado para os de outro com
+        `n_cultivares` cultivares; pares com cultivar ausente (-1) são descartados.
+        """
+        if codigos is None:
+            codigos, n_cultivares = np.arange(len(self._rotulos)), len(self._rotulos)
+        cod_head = codigos[self._cultivar[head]]
+        cod_check = codigos[self._cultivar[check]]
+        validos = (cod_head >= 0) & (cod_check >= 0)
+        chave = cod_head[validos] * n_cultivares + cod_check[validos]
+        return self._totais_por_chave(head[validos], check[validos], chave, n_cultivares * n_cultivares)
+
+    def _totais_por_chave(self, head, check, chave, n):
+        """Totais (COLUNAS_TOTAIS x n) dos pares de linhas-base, somados por `chave` (0 <= chave < n)."""
+        # Décimos de sc/ha, exatamente os valores de np.round(x, 1) * 10
+        head10 = np.rint(self._prod[head] * 10)
+        check10 = np.rint(self._prod[check] * 10)
+        dif10 = np.rint((self._prod[head] - self._prod[check]) * 10)
+        resultado = _classificar(dif10, check10, *self.limiar, escala=10)
+
+        return np.stack([
+            np.bincount(chave, minlength=n),
+            np.bincount(chave, weights=resultado == 1, minlength=n),
+            np.bincount(chave, weights=resultado == 0, minlength=n),
+            np.bincount(chave, weights=resultado == -1, minlength=n),
+            np.bincount(chave, weights=head10, minlength=n),
+            np.bincount(chave, weights=check10, minlength=n)
+        ]).astype(np.int64)
+
+    def _atualizar(self, anterior):
+        """Totais a partir dos de `anterior`, recalculando só os pares de linhas que mudaram."""
+        if anterior.limiar != self.limiar:
+            anterior = anterior.reclassificar(*self.limiar)
+        n_cultivares = len(self._rotulos)
+        codigos = np.array([self._codigos.get(rotulo, -1) for rotulo in anterior._rotulos.tolist()], dtype=np.int64)
+
+        # Pares entre linhas presentes nas duas execuções não mudam
+        saem = ~np.isin(anterior._hash_linhas, self._hash_linhas)
+        entram = ~np.isin(self._hash_linhas, anterior._hash_linhas)
+
+        totais = np.zeros((len(COLUNAS_TOTAIS), n_cultivares * n_cultivares), dtype=np.int64)
+        head, check = np.divmod(anterior._chaves, len(anterior._rotulos))
+        head, check = codigos[head], codigos[check]
+        validos = (head >= 0) & (check >= 0)
+        totais[:, head[validos] * n_cultivares + check[validos]] = anterior.totais[COLUNAS_TOTAIS].to_numpy().T[:, validos]
+
+        totais -= anterior._somar_pares(*anterior._pares_linhas(saem), codigos, n_cultivares)
+        totais += self._somar_pares(*self._pares_linhas(entram))
+        return totais
+
+    def __len__(self):
+        return int(self._inicio_pares[-1])
+
+    def __getstate__(self):
+        # Caches são refeitos sob demanda; não vão para o arquivo pré-calculado
+        estado = self.__dict__.copy()
+        estado.pop("_cache_comparacoes", None)
+        estado.pop("_reclassificados", None)
+        return estado
+
+    def __setstate__(self, estado):
+        # Resultados gravados antes dos intervalos, agregações e margem configurável existirem
+        estado.setdefault("_intervalos", {})
+        estado.setdefault("_locais", pd.DataFrame(index=range(len(estado["_fazendas"]))))
+        estado.setdefault("_agregados", None)
+        estado.setdefault("_safras", None)
+        estado.setdefault("limiar", (1.0, False))
+        estado.setdefault("_ranking", None)
+        estado["_cache_comparacoes"] = None
+        estado["_reclassificados"] = LRUCache(maxsize=RECLASSIFICACOES_GUARDADAS)
+        self.__dict__.update(estado)
+
+    def _comparacoes(self):
+        """Todas as comparações em décimos: posição do par em `totais`, diferença e check.
+
+        Gerado uma vez e guardado; é a base de `reclassificar`.
+        """
+        if self._cache_comparacoes is None:
+            head, check = self._pares_fazendas(np.arange(len(self._fazendas)))
+            chave = self._cultivar[head].astype(np.int64) * len(self._rotulos) + self._cultivar[check]
+            self._cache_comparacoes = (
+                np.searchsorted(self._chaves, chave).astype(np.int32),
+                np.rint((self._prod[head] - self._prod[check]) * 10).astype(np.int32),
+                np.rint(self._prod[check] * 10).astype(np.int32)
+            )
+        return self._cache_comparacoes
+
+    def reclassificar(self, limiar, relativo=False):
+        """Resultado com outra margem de empate (sc/ha ou % do check, com `relativo`).
+
+        Compartilha os arrays deste resultado; só vitórias, empates e derrotas mudam, com
+        uma comparação vetorizada sobre as diferenças já guardadas. Agregações e
+        intervalos são refeitos sob demanda. Os totais das últimas margens pedidas ficam
+        guardados, mas só a margem atual mantém agregações, intervalos e ranking.
+        """
+        limiar = (float(limiar), bool(relativo))
+        if limiar == self.limiar:
+            self._descartar_derivados(manter=self)
+            return self
+        if limiar not in self._reclassificados:
+            posicao, dif10, check10 = self._comparacoes()
+            resultado = _classificar(dif10, check10, *limiar, escala=10)
+            vitorias = np.bincount(posicao, weights=resultado == 1, minlength=len(self._chaves)).astype(np.int64)
+            derrotas = np.bincount(posicao, weights=resultado == -1, minlength=len(self._chaves)).astype(np.int64)
+
+            novo = copy.copy(self)
+            novo.limiar = limiar
+            novo.totais = self.totais.copy()
+            novo.totais["Vitorias"] = vitorias
+            novo.totais["Derrotas"] = derrotas
+            novo.totais["Empates"] = novo.totais["Num_Locais"] - vitorias - derrotas
+            novo._agregados = None
+            novo._intervalos = {}
+            novo._ranking = None
+            self._reclassificados[limiar] = novo
+        atual = self._reclassificados[limiar]
+        self._descartar_derivados(manter=atual)
+        return atual
+
+    def _descartar_derivados(self, manter):
+        """Libera agregações, intervalos e ranking das margens guardadas que não são `manter`."""
+        for resultado in [self, *self._reclassificados.values()]:
+            if resultado is not manter:
+                resultado._agregados = None
+                resultado._intervalos = {}
+                resultado._ranking = None
+
+    def margem(self, check):
+        """Margem de empate (sc/ha) para checks com produtividade `check` (sc/ha)."""
+        limiar, relativo = self.limiar
+        return np.asarray(check, dtype=np.float64) * (limiar / 100) if relativo else np.full(np.shape(check), limiar)
+
+    def varredura(self, head, check, limiares=None, relativo=None):
+        """% de vitórias, empates e derrotas do par para cada margem de `limiares`, numa só passada.
+
+        Sem `relativo`, usa o tipo de margem deste resultado; sem `limiares`, LIMIARES_VARREDURA.
+        """
+        relativo = self.limiar[1] if relativo is None else relativo
+        limiares = LIMIARES_VARREDURA[relativo] if limiares is None else limiares
+        linhas_head, linhas_check = self._linhas_par(head, check)
+        if head == check:
+            linhas_head, linhas_check = linhas_head[:0], linhas_check[:0]
+        dif10 = np.rint((self._prod[linhas_head] - self._prod[linhas_check]) * 10)
+        check10 = np.rint(self._prod[linhas_check] * 10)
+
+        limiares = np.asarray(limiares, dtype=np.float64)
+        resultado = _classificar(dif10, check10, limiares[:, None], relativo, escala=10)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return pd.DataFrame({
+                "Limiar": limiares,
+                "% Vitórias": (np.count_nonzero(resultado == 1, axis=1) / dif10.size * 100).round(1),
+                "% Empates": (np.count_nonzero(resultado == 0, axis=1) / dif10.size * 100).round(1),
+                "% Derrotas": (np.count_nonzero(resultado == -1, axis=1) / dif10.size * 100).round(1)
+            })
+
+    def niveis(self):
+        """Níveis de NIVEIS_HIERARQUIA disponíveis para agregação, do mais amplo ao mais fino."""
+        return list(self._locais.columns)
+
+    def agregado(self, nivel):
+        """Totais de cada par por grupo do nível (ex.: por Safra e Estado para "Estado").
+
+        Todos os níveis saem de uma única passada sobre os pares de cada local, no nível
+        mais fino; os demais são somas exatas dele. O resultado fica guardado no objeto.
+        """
+        agregados = self._agregados
+        if agregados is None:
+            agregados = self._agregados = self._agregar()
+        return agregados[nivel]
+
+    def _agregar(self):
+        colunas = self.niveis()
+        if not colunas:
+            return {}
+        n_pares = len(self._rotulos) ** 2
+
+        # Grupo mais fino (combinação de todos os níveis) de cada local; uma fazenda em
+        # duas safras é um local em cada, então a Safra de cada par é a do próprio ensaio
+        finos = self._locais.groupby(colunas, dropna=False, sort=True)
+        grupo_fazenda = finos.ngroup().to_numpy()
+        grupos = finos.size().index.to_frame(index=False)
+
+        head, check = self._pares_fazendas(np.arange(len(self._fazendas)))
+        chave = (grupo_fazenda[self._fazenda[head]].astype(np.int64) * n_pares
+                 + self._cultivar[head].astype(np.int64) * len(self._rotulos) + self._cultivar[check])
+        if len(grupos) * n_pares <= CHAVES_DENSAS:
+            # Poucas combinações possíveis: soma direta, sem ordenar as chaves
+            totais = self._totais_por_chave(head, check, chave, len(grupos) * n_pares)
+            chaves = np.flatnonzero(totais[0])
+            totais = totais[:, chaves]
+        else:
+            chaves, inverso = np.unique(chave, return_inverse=True)
+            totais = self._totais_por_chave(head, check, inverso, len(chaves))
+
+        agregados = {}
+        for profundidade in range(len(colunas), 0, -1):
+            if profundidade < len(colunas):
+                # Nível acima: soma dos grupos mais finos que pertencem a cada grupo
+                acima = grupos.groupby(colunas[:profundidade], dropna=False, sort=True)
+                grupo = acima.ngroup().to_numpy()
+                chave = grupo[chaves // n_pares].astype(np.int64) * n_pares + chaves % n_pares
+                novas, inverso = np.unique(chave, return_inverse=True)
+                totais = np.stack([np.bincount(inverso, weights=linha, minlength=len(novas)) for linha in totais]).astype(np.int64)
+                chaves = novas
+                grupos = acima.size().index.to_frame(index=False)
+
+            par = chaves % n_pares
+            tabela = grupos.iloc[chaves // n_pares].reset_index(drop=True)
+            tabela["Head"] = self._rotulos[par // len(self._rotulos)]
+            tabela["Check"] = self._rotulos[par % len(self._rotulos)]
+            for coluna, valores in zip(COLUNAS_TOTAIS, totais):
+                tabela[coluna] = valores
+            # As somas em décimos de sc/ha são internas; as médias já saem em sc/ha
+            agregados[colunas[profundidade - 1]] = _com_medias(tabela, arredondar=True).drop(columns=["Soma_Head", "Soma_Check"])
+        return agregados
+
+    def intervalos(self, chaves=None, reamostragens=REAMOSTRAGENS, confianca=CONFIANCA, semente=0):
+        """Intervalos bootstrap (percentis) da diferença média (sc/ha) e do % de vitórias dos pares.
+
+        Reamostra locais: cada fazenda recebe um peso Poisson(1) por reamostragem, o
+        mesmo para todos os pares, e as somas ponderadas de todos os pares saem de uma
+        multiplicação de matrizes (reamostragens x fazendas) @ (fazendas x pares), em
+        blocos. Por isso o intervalo de um par não depende de quais outros foram pedidos.
+        `chaves` são pares (head, check); None calcula todos.
+        """
+        memoria = self._intervalos.setdefault((reamostragens, confianca, semente), {})
+        indice = self.totais.index if chaves is None else pd.MultiIndex.from_tuples(list(chaves), names=["Head", "Check"])
+        indice = indice[indice.isin(self.totais.index)]
+
+        faltando = [chave for chave in indice if chave not in memoria]
+        if faltando:
+            memoria.update(zip(faltando, self._bootstrap(faltando, reamostragens, confianca, semente)))
+        return pd.DataFrame([memoria[chave] for chave in indice], index=indice, columns=COLUNAS_INTERVALOS)
+
+    def _bootstrap(self, chaves, reamostragens, confianca, semente):
+        """Linhas (COLUNAS_INTERVALOS) dos pares informados, na mesma ordem."""
+        n_cultivares, n_fazendas = len(self._rotulos), len(self._fazendas)
+        pesos = np.random.default_rng(semente).poisson(1.0, (reamostragens, n_fazendas)).astype(np.float64)
+        quantis = [(1 - confianca) / 2, (1 + confianca) / 2]
+
+        codigos = np.array([self._codigos[h] * n_cultivares + self._codigos[c] for h, c in chaves], dtype=np.int64)
+        ordem = np.argsort(codigos, kind="stable")
+        resultado = np.empty((len(chaves), len(COLUNAS_INTERVALOS)))
+
+        # Blocos de pares agrupados por head, limitando as matrizes reamostragens x pares e fazendas x pares
+        tamanho_bloco = max(1, ELEMENTOS_POR_BLOCO // max(reamostragens, n_fazendas))
+        for inicio in range(0, len(ordem), tamanho_bloco):
+            posicoes = ordem[inicio:inicio + tamanho_bloco]
+            bloco = codigos[posicoes]
+
+            # Todas as comparações em que o head é um dos heads do bloco
+            linhas = np.flatnonzero(np.isin(self._cultivar, np.unique(bloco // n_cultivares)))
+            fazenda = self._fazenda[linhas]
+            tamanhos = self._tamanhos[fazenda]
+            head = np.repeat(linhas, tamanhos)
+            check = (np.repeat(self._inicio[fazenda], tamanhos) + np.arange(tamanhos.sum())
+                     - np.repeat(np.cumsum(tamanhos) - tamanhos, tamanhos))
+
+            chave = self._cultivar[head].astype(np.int64) * n_cultivares + self._cultivar[check]
+            par = np.searchsorted(bloco, chave)
+            no_bloco = (head != check) & (par < bloco.size) & (bloco[np.minimum(par, bloco.size - 1)] == chave)
+            head, check, par = head[no_bloco], check[no_bloco], par[no_bloco]
+
+            # Matrizes fazendas x pares: comparações, soma das diferenças (décimos) e vitórias
+            celula = self._fazenda[head].astype(np.int64) * bloco.size + par
+            dif10 = np.rint((self._prod[head] - self._prod[check]) * 10)
+            vitoria = _classificar(dif10, np.rint(self._prod[check] * 10), *self.limiar, escala=10) == 1
+            forma = (n_fazendas, bloco.size)
+            n = pesos @ np.bincount(celula, minlength=n_fazendas * bloco.size).reshape(forma)
+            soma = pesos @ np.bincount(celula, weights=dif10, minlength=n_fazendas * bloco.size).reshape(forma)
+            vitorias = pesos @ np.bincount(celula, weights=vitoria, minlength=n_fazendas * bloco.size).reshape(forma)
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                n[n == 0] = np.nan
+                dif = _quantis(soma / (10 * n), quantis)
+                vit = _quantis(vitorias / n * 100, quantis)
+            resultado[posicoes] = np.column_stack([dif[0], dif[1], vit[0], vit[1]]).round(1)
+        return resultado.tolist()
+
+    def _montar(self, head, check):
+        """Linhas da tabela H2H para os pares de linhas-base (head, check)."""
+        fazenda = self._fazenda[head]
+        local_head = head - self._inicio[fazenda]
+        local_check = check - self._inicio[fazenda]
+        posicao = self._inicio_pares[fazenda] + local_head * (self._tamanhos[fazenda] - 1) + local_check - (local_check > local_head)
+
+        diff = self._prod[head] - self._prod[check]
+        # Classificação em décimos, como nos totais (médias de repetições caem fora da grade de 0,1)
+        resultado = _classificar(np.rint(diff * 10), np.rint(self._prod[check] * 10), *self.limiar, escala=10)
+        vitoria = resultado == 1
+
+        safra = {} if self._safras is None else {"Safra": self._safras[fazenda]}
+        return pd.DataFrame({
+            **safra,
+            "Fazenda": self._fazendas[fazenda],
+            "Head": self._rotulos[self._cultivar[head]],
+            "Check": self._rotulos[self._cultivar[check]],
+            "Head_Mean": np.round(self._prod[head], 1),
+            "Check_Mean": np.round(self._prod[check], 1),
+            "Difference (sc/ha)": np.round(diff, 1),
+            "Vitória": vitoria.astype(int),
+            "Empate": (resultado == 0).astype(int),
+            "% Vitória": np.where(vitoria, 100.0, 0.0)
+        }, index=posicao)
+
+    def _linhas_par(self, head, check):
+        """Linhas-base do head e do check nas fazendas em comum, em ordem de fazenda."""
+        if head not in self._codigos or check not in self._codigos:
+            return self._linhas_cultivar[:0], self._linhas_cultivar[:0]
+        linhas = []
+        for codigo in (self._codigos[head], self._codigos[check]):
+            linhas.append(self._linhas_cultivar[self._inicio_cultivar[codigo]:self._inicio_cultivar[codigo + 1]])
+        _, i_head, i_check = np.intersect1d(
+            self._fazenda[linhas[0]], self._fazenda[linhas[1]], assume_unique=True, return_indices=True
+        )
+        return linhas[0][i_head], linhas[1][i_check]
+
+    def tabela(self):
+        """Tabela completa, uma linha por Fazenda/Head/Check."""
+        return self._montar(*_indices_pares(self._tamanhos))
+
+    def comparacoes(self, heads):
+        """Linhas da tabela cujo head está em `heads`, numa só passada, na ordem da tabela."""
+        codigos = [self._codigos[head] for head in heads if head in self._codigos]
+        head, check = _indices_pares(self._tamanhos)
+        manter = np.isin(self._cultivar[head], codigos)
+        return self._montar(head[manter], check[manter])
+
+    def par(self, head, check):
+        """Linhas do par head x check, na ordem da tabela."""
+        if head == check:
+            return self._montar(*_indices_pares([]))
+        return self._montar(*self._linhas_par(head, check))
+
+    def totais_par(self, head, check):
+        """Totais inteiros do par (COLUNAS_TOTAIS) ou None."""
+        if (head, check) not in self.totais.index:
+            return None
+        return self.totais.loc[(head, check), COLUNAS_TOTAIS]
+
+    def media_head(self, head, checks):
+        """Produtividade média do head nas comparações com os checks informados."""
+        tabelas = [self.par(head, check) for check in checks]
+        if not tabelas:
+            return np.nan
+        return pd.concat(tabelas).sort_index()["Head_Mean"].mean()
+
+    def resumo(self, head, checks, reamostragens=0):
+        """Tabela comparativa do head contra cada check, uma linha por check.
+
+        Com `reamostragens`, inclui os intervalos bootstrap (ver `intervalos`).
+        """
+        chaves = [(head, check) for check in sorted(set(checks)) if (head, check) in self.totais.index]
+        return self._resumir(self.totais.loc[chaves], reamostragens).drop(columns="Head")
+
+    def resumo_geral(self, reamostragens=0):
+        """Tabela comparativa de todos os pares, uma linha por head/check."""
+        return self._resumir(self.totais, reamostragens)
+
+    def _resumir(self, totais, reamostragens=0):
+        colunas_ic = []
+        if reamostragens:
+            totais = totais.join(self.intervalos(totais.index, reamostragens))
+            colunas_ic = COLUNAS_INTERVALOS
+        resumo = totais.reset_index()
+
+        resumo.rename(columns={
+            "Check": "Cultivar Check",
+            "Diferenca_Media": "Diferença Média",
+            "Check_Mean": "Prod_sc_ha_media",
+            "Head_Mean": "Head_sc_ha_media"
+        }, inplace=True)
+
+        resumo["% Vitórias"] = (resumo["Vitorias"] / resumo["Num_Locais"] * 100).round(1)
+
+        # Arredonda a partir das somas exatas em décimos (empates vão para o par)
+        n = resumo["Num_Locais"]
+        resumo["Prod_sc_ha_media"] = np.rint(resumo["Soma_Check"] / n) / 10
+        resumo["Head_sc_ha_media"] = np.rint(resumo["Soma_Head"] / n) / 10
+        resumo["Diferença Média"] = np.rint((resumo["Soma_Head"] - resumo["Soma_Check"]) / n) / 10
+
+        return resumo[[
+            "Head",
+            "Cultivar Check",
+            "Num_Locais",
+            "Prod_sc_ha_media",
+            "Head_sc_ha_media",
+            "Diferença Média",
+            "% Vitórias"
+        ] + colunas_ic]
+
+    def ranking(self):
+        """Classificação de todos os cultivares contra o painel inteiro (modelo de Bradley-Terry).
+
+        A força p de cada cultivar é ajustada às vitórias de todos os pares ao mesmo
+        tempo (empate vale meia vitória): P(i vence j) = p_i / (p_i + p_j). O ajuste
+        trabalha sobre a lista de pares com comparações, que é esparsa, sem montar a
+        matriz cultivar x cultivar (ver `_forcas_bradley_terry`). O resultado fica
+        guardado no objeto, que já corresponde a um conjunto de dados, filtros e margem.
+        """
+        # Variável local: outra margem pode descartar o cache enquanto um relatório o lê
+        ranking = self._ranking
+        if ranking is None:
+            ranking = self._ranking = self._ajustar_ranking()
+        return ranking
+
+    def _ajustar_ranking(self):
+        n_cultivares = len(self._rotulos)
+        head, check = np.divmod(self._chaves, n_cultivares)
+        totais = self.totais
+        jogos = totais["Num_Locais"].to_numpy(dtype=np.float64)
+        vitorias = (totais["Vitorias"] + totais["Empates"] / 2).to_numpy(dtype=np.float64)
+        # O cultivar fictício, de força 1, fixa a escala das forças
+        forca = np.exp(_forcas_bradley_terry(head, check, jogos, vitorias, n_cultivares))
+
+        # Cobertura: comparações, adversários e locais de cada cultivar
+        linhas_com_par = self._tamanhos[self._fazenda] > 1
+        ranking = pd.DataFrame({
+            "Cultivar": self._rotulos,
+            "Forca_BT": np.log(forca).round(3),
+            "% Vitória vs Média": (forca / (forca + 1) * 100).round(1),
+            "Num_Locais": np.bincount(self._cultivar[linhas_com_par], minlength=n_cultivares),
+            "Comparacoes": np.bincount(head, weights=jogos, minlength=n_cultivares).astype(np.int64),
+            "Adversarios": np.bincount(head, minlength=n_cultivares),
+            "Vitorias": np.bincount(head, weights=totais["Vitorias"], minlength=n_cultivares).astype(np.int64),
+            "Empates": np.bincount(head, weights=totais["Empates"], minlength=n_cultivares).astype(np.int64),
+            "Derrotas": np.bincount(head, weights=totais["Derrotas"], minlength=n_cultivares).astype(np.int64),
+            "Soma_Dif": np.bincount(head, weights=totais["Soma_Head"] - totais["Soma_Check"], minlength=n_cultivares)
+        })
+        ranking = ranking[ranking["Comparacoes"] > 0]
+        ranking["% Vitórias"] = (ranking["Vitorias"] / ranking["Comparacoes"] * 100).round(1)
+        ranking["Diferença Média"] = np.rint(ranking["Soma_Dif"] / ranking["Comparacoes"]) / 10
+        ranking = ranking.sort_values(["Forca_BT", "Cultivar"], ascending=[False, True], kind="stable")
+        ranking.insert(0, "Posição", np.arange(1, len(ranking) + 1))
+        return ranking.drop(columns="Soma_Dif").reset_index(drop=True)
+
+
+# Acima deste número de locais o gráfico por local é resumido (tamanho fixo)
+LIMITE_BARRAS_LOCAL = config("H2H_LIMITE_BARRAS_LOCAL", default=40, cast=int)
+FAIXAS_HISTOGRAMA = 30
+
+
+def extremos(df, coluna, n):
+    """As `n` linhas de menor e as `n` de maior valor da coluna, em ordem crescente."""
+    df = df.sort_values(coluna, kind="stable")
+    if len(df) <= 2 * n:
+        return df
+    return pd.concat([df.head(n), df.tail(n)])
+
+
+def diferencas_por_grupo(par, df, coluna):
+    """Diferença média do par, check médio e número de locais por grupo de fazendas (ex.: Microrregiao, Estado).
+
+    `par` é a tabela do par (ver `ResultadoH2H.par`); `df` traz a coluna de grupo de cada local.
+    """
+    local = [col for col in ["Fazenda", "Safra"] if col in par.columns and col in df.columns and col != coluna]
+    grupos = df.drop_duplicates(local)[local + [coluna]].astype(object)
+    resumo = (
+        par.drop(columns=coluna, errors="ignore").astype({col: object for col in local})
+        .merge(grupos, on=local, how="left")
+        .groupby(coluna, dropna=False)
+        .agg(**{
+            "Difference (sc/ha)": ("Difference (sc/ha)", "mean"),
+            "Check_Mean": ("Check_Mean", "mean"),
+            "Num_Locais": ("Difference (sc/ha)", "size")
+        })
+        .reset_index()
+    )
+    resumo[coluna] = resumo[coluna].fillna("(sem valor)").astype(str)
+    resumo["Difference (sc/ha)"] = resumo["Difference (sc/ha)"].round(1)
+    return resumo.sort_values("Difference (sc/ha)", kind="stable")
+
+
+def histograma_diferencas(diferencas, n_faixas=FAIXAS_HISTOGRAMA):
+    """Contagem de locais por faixa de diferença, calculada no servidor (Centro, Largura, Locais)."""
+    contagens, bordas = np.histogram(np.asarray(diferencas, dtype=float), bins=n_faixas)
+    return pd.DataFrame({"Centro": (bordas[:-1] + bordas[1:]) / 2, "Largura": np.diff(bordas), "Locais": contagens})
+
+
+# Trabalhos em segundo plano (ex.: relatórios), fora da execução do app
+TAREFAS_SIMULTANEAS = config("H2H_TAREFAS", default=2, cast=int)
+_executor_tarefas = ThreadPoolExecutor(max_workers=TAREFAS_SIMULTANEAS, thread_name_prefix="h2h-tarefa")
+
+
+class Tarefa:
+    """Chamada de `funcao` numa thread em segundo plano, com progresso consultável.
+
+    A função recebe `progresso(feitos, total)`; qualquer execução do app pode consultar
+    `fracao` e `pronta` enquanto ela roda. `resultado` devolve o valor ou levanta o erro.
+    """
+
+    def __init__(self, funcao, *args, **kwargs):
+        self.feitos, self.total = 0, 1
+        self._futuro = _executor_tarefas.submit(funcao, *args, progresso=self._progresso, **kwargs)
+
+    def _progresso(self, feitos, total):
+        self.feitos, self.total = feitos, total
+
+    def fracao(self):
+        return min(self.feitos / max(self.total, 1), 1.0)
+
+    def pronta(self):
+        return self._futuro.done()
+
+    def resultado(self):
+        return self._futuro.result()
+
+
+def gerar_relatorio(resultado, heads=None, progresso=None):
+    """Bytes de um xlsx com o relatório dos heads (todos, sem `heads`).
+
+    Abas: Ranking, Resumo (todos os pares dos heads), uma por head com a tabela contra
+    cada check e um gráfico nativo do Excel, e Comparações (linhas por local). O resumo
+    sai de uma só passada sobre os totais e as comparações de uma só passada sobre os
+    pares; as abas por head são fatias do resumo. `progresso(feitos, total)` é chamado a
+    cada aba concluída.
+    """
+    heads = resultado.cultivares if not heads else sorted(set(heads) & set(resultado.cultivares))
+    resumo = resultado.resumo_geral()
+    resumo = resumo[resumo["Head"].isin(heads)]
+    total, feitos = len(heads) + 3, 0
+
+    def avancar():
+        nonlocal feitos
+        feitos += 1
+        if progresso is not None:
+            progresso(feitos, total)
+
+    buffer = io.BytesIO()
+    wb = xlsxwriter.Workbook(buffer, {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss"})
+    negrito = wb.add_format({"bold": True, "border": 1, "align": "center"})
+    titulo = wb.add_format({"bold": True, "font_size": 14})
+    margem = f"±{resultado.limiar[0]:g} {'% do check' if resultado.limiar[1] else 'sc/ha'}"
+    usados = set()
+
+    _escrever_abas(wb, "Ranking", resultado.ranking(), negrito, usados)
+    avancar()
+    _escrever_abas(wb, "Resumo", resumo, negrito, usados)
+    avancar()
+
+    colunas = list(resumo.columns.drop("Head"))
+    for head, tabela in resumo.groupby("Head", sort=True, observed=True):
+        ws = _escrever_abas(wb, head, tabela[colunas], negrito, usados, titulo=(f"Head: {head} | Margem de empate: {margem}", titulo))
+
+        # Gráfico nativo (desenhado pelo Excel), como o da comparação multichecks
+        linhas = min(len(tabela), LINHAS_POR_ABA - 3)
+        grafico = wb.add_chart({"type": "bar"})
+        grafico.add_series({
+            "name": "Diferença Média",
+            "categories": [ws.name, 3, colunas.index("Cultivar Check"), 2 + linhas, colunas.index("Cultivar Check")],
+            "values": [ws.name, 3, colunas.index("Diferença Média"), 2 + linhas, colunas.index("Diferença Média")],
+            "data_labels": {"value": True},
+            "fill": {"color": "#01B8AA"},
+            "invert_if_negative": True,
+            "invert_if_negative_color": "#FD625E"
+        })
+        grafico.set_title({"name": f"Diferença Média de Produtividade - {head}"})
+        grafico.set_x_axis({"name": "Diferença Média (sc/ha)"})
+        grafico.set_legend({"none": True})
+        grafico.set_size({"width": 640, "height": max(320, 22 * linhas)})
+        ws.insert_chart(2, len(colunas) + 1, grafico)
+        avancar()
+
+    _escrever_abas(wb, "Comparações", resultado.comparacoes(heads), negrito, usados)
+    wb.close()
+    avancar()
+    return buffer.getvalue()
+
+
+# Arquivo JSON-lines onde cada execução do app grava suas etapas (vazio: não grava)
+LOG_DIAGNOSTICO = config("H2H_LOG_DIAGNOSTICO", default="")
+_trava_log = threading.Lock()
+
+# Execuções em andamento que medem memória; o tracemalloc fica ligado enquanto houver alguma
+_medicoes_memoria = 0
+_trava_medicoes = threading.Lock()
+
+
+def _iniciar_medicao():
+    global _medicoes_memoria
+    with _trava_medicoes:
+        _medicoes_memoria += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+def _encerrar_medicao():
+    global _medicoes_memoria
+    with _trava_medicoes:
+        _medicoes_memoria -= 1
+        if _medicoes_memoria == 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+class Diagnostico:
+    """Tempo, linhas e variação de memória de cada etapa de uma execução do app.
+
+    Funciona como cronômetro de voltas: `marcar` fecha a etapa que começou na marca
+    anterior (ou na criação), de modo que as etapas somam a execução inteira.
+    A memória vem do tracemalloc, que é global ao processo e deixa tudo mais lento;
+    por isso só fica ligado enquanto alguma execução com `memoria=True` estiver em
+    andamento (até `gravar`, ou até o objeto ser descartado se a execução for interrompida).
+    """
+
+    def __init__(self, memoria=False):
+        self.registros = []
+        self.memoria = memoria
+        # Passa a True quando a execução termina em `gravar`
+        self.encerrado = False
+        self._encerrar_medicao = None
+        if memoria:
+            _iniciar_medicao()
+            self._encerrar_medicao = weakref.finalize(self, _encerrar_medicao)
+        self._criacao = self._marca = time.perf_counter()
+        self._bytes = tracemalloc.get_traced_memory()[0] if memoria else None
+
+    def marcar(self, etapa, linhas=None):
+        """Registra a etapa que termina agora."""
+        agora = time.perf_counter()
+        registro = {"Etapa": etapa, "Linhas": linhas, "Segundos": round(agora - self._marca, 4)}
+        if self.memoria:
+            # Sem rastreamento (desligado por fora) a variação não tem sentido
+            atual = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+            registro["Memoria_MB"] = None if atual is None or self._bytes is None else round((atual - self._bytes) / 1024 ** 2, 2)
+            self._bytes = atual
+        self.registros.append(registro)
+        self._marca = agora
+
+    def total(self):
+        return time.perf_counter() - self._criacao
+
+    def tabela(self):
+        colunas = ["Etapa", "Linhas", "Segundos"] + (["Memoria_MB"] if self.memoria else [])
+        return pd.DataFrame(self.registros, columns=colunas).astype({"Linhas": "Int64"})
+
+    def gravar(self, caminho=LOG_DIAGNOSTICO, **contexto):
+        """Acrescenta as etapas desta execução ao log JSON-lines, uma linha por etapa."""
+        self.encerrado = True
+        if self._encerrar_medicao is not None:
+            self._encerrar_medicao()
+        if not caminho:
+            return
+        instante = time.strftime("%Y-%m-%dT%H:%M:%S")
+        linhas = [json.dumps({"instante": instante, **contexto, **registro}, ensure_ascii=False) for registro in self.registros]
+        with _trava_log, open(caminho, "a", encoding="utf-8") as arquivo:
+            arquivo.write("".join(linha + "\n" for linha in linhas))
+
+
+# Resultados gravados pela linha de comando, pela assinatura dos dados (H2H_PRECALCULADO)
+DIRETORIO_PRECALCULADO = config("H2H_PRECALCULADO", default="h2h_precalculado")
+
+
+def salvar_precalculado(resultado, assinatura, raiz=DIRETORIO_PRECALCULADO):
+    """Grava o `ResultadoH2H` para ser reaproveitado pelo app com os mesmos dados."""
+    os.makedirs(raiz, exist_ok=True)
+    caminho = os.path.join(raiz, f"{assinatura}.pkl")
+    with open(caminho + ".tmp", "wb") as arquivo:
+        pickle.dump(resultado, arquivo, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(caminho + ".tmp", caminho)
+    return caminho
+
+
+def abrir_precalculado(assinatura, raiz=DIRETORIO_PRECALCULADO):
+    """`ResultadoH2H` pré-calculado para os dados com esta assinatura, ou None.
+
+    Um arquivo ilegível (corrompido ou de outra versão do código) é tratado como ausente.
+    """
+    caminho = os.path.join(raiz, f"{assinatura}.pkl")
+    if not os.path.exists(caminho):
+        return None
+    try:
+        with open(caminho, "rb") as arquivo:
+            resultado = pickle.load(arquivo)
+    except (OSError, EOFError, AttributeError, ImportError, pickle.UnpicklingError):
+        return None
+    return resultado if isinstance(resultado, ResultadoH2H) else None
+
+
+def analisar(df, processos=1):
+    """Calcula o Head to Head de um DataFrame normalizado e grava o resultado pré-calculado."""
+    resultado = ResultadoH2H(df, processos=processos)
+    salvar_precalculado(resultado, assinatura_df(df))
+    return resultado
+
+
+def _gravar(df, caminho, formato):
+    if formato == "csv":
+        df.to_csv(caminho, index=False)
+    else:
+        df.to_parquet(caminho, index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m h2h",
+        description="Calcula o Head to Head de planilhas de ensaio e grava os pares e o resumo."
+    )
+    parser.add_argument("planilhas", nargs="*", help="arquivos Excel (.xlsx) de ensaio")
+    parser.add_argument("--base", action="store_true", help="analisar a base Parquet inteira (H2H_DATASET)")
+    parser.add_argument("--juntar", action="store_true", help="analisar as planilhas como um único conjunto")
+    parser.add_argument("--saida", default=".", help="diretório dos arquivos gerados (padrão: atual)")
+    parser.add_argument("--formato", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument("--processos", type=int, default=1, help="processos para somar os pares (padrão: 1)")
+    parser.add_argument("--niveis", action="store_true", help="grava também os totais por Safra, Estado, Microrregiao e Cidade")
+    parser.add_argument("--reamostragens", type=int, default=0, help="inclui no resumo intervalos bootstrap com N reamostragens")
+    parser.add_argument("--limiar", type=float, default=LIMIAR_EMPATE, help=f"margem de empate em sc/ha (padrão: {LIMIAR_EMPATE})")
+    parser.add_argument("--relativo", action="store_true", help="--limiar em %% da produtividade do check")
+    parser.add_argument("--relatorio", action="store_true", help="grava também o relatório em lote (.xlsx) de todos os heads")
+    args = parser.parse_args(argv)
+
+    if not args.planilhas and not args.base:
+        parser.error("informe ao menos uma planilha ou --base")
+
+    conjuntos = []
+    try:
+        tabelas = [(os.path.splitext(os.path.basename(p))[0], ler_excel(p)) for p in args.planilhas]
+    except (ErroIngestao, OSError) as erro:
+        parser.exit(1, f"Erro ao ler planilha: {erro}\n")
+    if args.juntar and tabelas:
+        conjuntos.append(("h2h", _categorizar(pd.concat([df for _, df in tabelas], ignore_index=True))))
+    else:
+        conjuntos.extend(tabelas)
+    if args.base:
+        dados = carregar_dataset()
+        if dados is None:
+            parser.exit(1, f"Base Parquet não encontrada: {DIRETORIO_DATASET}\n")
+        conjuntos.append(("base", dados.df))
+
+    os.makedirs(args.saida, exist_ok=True)
+    for nome, df in conjuntos:
+        # O pré-calculado fica com a margem padrão; o app reclassifica conforme a escolha
+        resultado = analisar(df, args.processos).reclassificar(args.limiar, args.relativo)
+        saidas = [
+            ("pares", resultado.tabela()),
+            ("resumo", resultado.resumo_geral(args.reamostragens)),
+            ("ranking", resultado.ranking())
+        ]
+        if args.niveis:
+            saidas += [(nivel.lower(), resultado.agregado(nivel)) for nivel in resultado.niveis()]
+        for sufixo, tabela in saidas:
+            caminho = os.path.join(args.saida, f"{nome}_{sufixo}.{args.formato}")
+            _gravar(tabela, caminho, args.formato)
+            print(f"{caminho}: {len(tabela)} linhas")
+        if args.relatorio:
+            caminho = os.path.join(args.saida, f"{nome}_relatorio.xlsx")
+            with open(caminho, "wb") as arquivo:
+                arquivo.write(gerar_relatorio(resultado))
+            print(f"{caminho}: relatório de {len(resultado.cultivares)} heads")
+    return 0
+
+
+if __name__ == "__main__":
+    # Importado pelo nome, para que os resultados gravados referenciem h2h.ResultadoH2H e não __main__
+    from h2h import main
+    raise SystemExit(main())
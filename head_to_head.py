@@ -1,44 +1,720 @@
+import functools
+import uuid
+
 import streamlit as st
-import pandas as pd
-import io
 import plotly.graph_objects as go
-from st_aggrid import AgGrid, GridOptionsBuilder
+from st_aggrid import AgGrid, GridOptionsBuilder, JsCode
+
+from h2h import (
+    COLUNAS_PARTICAO, CONFIANCA, FORMATOS_EXPORTACAO, LIMIAR_EMPATE, LIMITE_BARRAS_LOCAL, LINHAS_POR_PAGINA, PROCESSOS,
+    REAMOSTRAGENS, Diagnostico, ErroIngestao, ResultadoH2H, Tarefa, abrir_precalculado, adicionar_dataset,
+    agregar_repeticoes, assinatura_df, carregar_dataset, carregar_excel, diferencas_por_grupo, exportar, extremos,
+    gerar_relatorio, histograma_diferencas, paginar, particoes_dataset
+)
+
+# Intervalo (s) entre atualizações da barra de progresso de trabalhos em segundo plano
+INTERVALO_PROGRESSO = 1.0
+
+
+def rotulo_opcao(valor):
+    """Rótulo de uma opção de filtro; None são as linhas sem valor na coluna."""
+    return "(sem valor)" if valor is None else valor
+
+
+def botao_exportacao(df, label, nome_arquivo, nome_aba, key):
+    """Gera o arquivo só quando o usuário pede; o conteúdo fica memorizado em `exportar`."""
+    formato = st.radio(
+        f"Formato - {label}", list(FORMATOS_EXPORTACAO), horizontal=True,
+        key=f"{key}_formato", label_visibility="collapsed"
+    )
+    extensao, mime = FORMATOS_EXPORTACAO[formato]
+
+    if st.button("⚙️ Preparar arquivo", key=f"{key}_preparar"):
+        st.session_state[f"{key}_pedido"] = (formato, assinatura_df(df))
+
+    # Pedido anterior só vale enquanto formato e dados forem os mesmos
+    pedido = st.session_state.get(f"{key}_pedido")
+    if pedido is None or pedido[0] != formato:
+        return
+    if pedido[1] != assinatura_df(df):
+        del st.session_state[f"{key}_pedido"]
+        return
+
+    st.download_button(
+        label=label,
+        data=exportar(df, formato, nome_aba, assinatura=pedido[1]),
+        file_name=f"{nome_arquivo}.{extensao}",
+        mime=mime,
+        key=f"{key}_baixar",
+        on_click="ignore"
+    )
+
+
+def paginacao(df, key, tamanho_pagina):
+    """Filtro, ordenação e página feitos no servidor; devolve só as linhas a exibir."""
+    colunas = list(df.columns)
+    col_ordem, col_sentido, col_coluna, col_texto, col_pagina = st.columns([0.22, 0.12, 0.22, 0.28, 0.16])
+    with col_ordem:
+        ordenar_por = st.selectbox("Ordenar por", ["—"] + colunas, key=f"{key}_ordem")
+    with col_sentido:
+        sentido = st.radio("Sentido", ["↑", "↓"], horizontal=True, key=f"{key}_sentido")
+    with col_coluna:
+        coluna_filtro = st.selectbox("Filtrar coluna", colunas, key=f"{key}_filtro_coluna")
+    with col_texto:
+        texto_filtro = st.text_input("Contém (ou >, <, = para números)", key=f"{key}_filtro_texto")
+    with col_pagina:
+        pagina = st.number_input("Página", min_value=1, step=1, key=f"{key}_pagina")
+
+    opcoes = dict(
+        ordenar_por=None if ordenar_por == "—" else ordenar_por,
+        crescente=sentido == "↑",
+        filtro=(coluna_filtro, texto_filtro)
+    )
+    try:
+        fatia, total = paginar(df, pagina, tamanho_pagina, **opcoes)
+    except ValueError as erro:
+        st.warning(f"⚠️ {erro}")
+        opcoes["filtro"] = None
+        fatia, total = paginar(df, pagina, tamanho_pagina, **opcoes)
+
+    n_paginas = max(1, -(-total // tamanho_pagina))
+    if pagina > n_paginas:
+        pagina = n_paginas
+        fatia, total = paginar(df, pagina, tamanho_pagina, **opcoes)
+
+    st.caption(f"Página {pagina} de {n_paginas} · {total} linhas")
+    return fatia
+
+
+def secao(funcao):
+    """Seção da página como `st.fragment`: interagir com ela reexecuta só a seção.
+
+    Na execução completa as etapas entram no diagnóstico da página. Numa reexecução
+    só da seção esse diagnóstico já foi gravado, então a seção usa um próprio.
+    """
+    @st.fragment
+    @functools.wraps(funcao)
+    def executar(*args, diagnostico, **kwargs):
+        if not diagnostico.encerrado:
+            return funcao(*args, diagnostico=diagnostico, **kwargs)
+
+        diagnostico = Diagnostico(memoria=diagnostico.memoria)
+        funcao(*args, diagnostico=diagnostico, **kwargs)
+        if st.session_state.get("mostrar_diagnostico"):
+            st.caption(f"🩺 Só esta seção foi reexecutada: {diagnostico.total():.2f} s")
+        diagnostico.gravar(sessao=st.session_state.get("sessao_diagnostico"), secao=funcao.__name__)
+
+    return executar
+
+
+@secao
+def secao_tabela_filtrada(df_exibicao, tamanho_pagina, diagnostico):
+    """Grade e exportação da tabela filtrada."""
+    # Só a página visível vai para o navegador; ordenação e filtro são feitos no servidor
+    df_pagina = paginacao(df_exibicao, "grade_filtrada", tamanho_pagina)
+
+    gb = GridOptionsBuilder.from_dataframe(df_pagina)
+    gb.configure_default_column(resizable=True, sortable=False, filter=False)
+    grid_options = gb.build()
+
+    custom_css = {
+        ".ag-header-cell-text": {
+            "font-weight": "bold",
+            "color": "black"
+        }
+    }
+
+    AgGrid(
+        df_pagina,
+        gridOptions=grid_options,
+        height=500,
+        custom_css=custom_css
+    )
+    diagnostico.marcar("Tabela filtrada (AgGrid)", len(df_pagina))
+
+    # Exportar tabela filtrada
+    botao_exportacao(df_exibicao, "📥 Baixar Tabela com Filtros", "tabela_filtrada", "Tabela Filtrada", key="exp_filtrada")
+    diagnostico.marcar("Exportação: tabela filtrada", len(df_exibicao))
+
+
+@secao
+def secao_resultado_h2h(resultado, tamanho_pagina, diagnostico):
+    """Tabela do resultado Head to Head, por fazenda ou agregada."""
+    st.markdown("## 📊 Resultado Head to Head")
+
+    # Agregações por Safra, Estado, ... são calculadas uma vez e ficam no resultado
+    nivel_h2h = st.selectbox(
+        "Nível da análise", ["Fazenda"] + resultado.niveis(),
+        format_func=lambda nivel: "Microrregião" if nivel == "Microrregiao" else nivel, key="nivel_h2h"
+    )
+    if nivel_h2h == "Fazenda":
+        df_h2h = resultado.tabela()
+    else:
+        df_h2h = resultado.agregado(nivel_h2h)
+    diagnostico.marcar(f"Resultado H2H por {nivel_h2h}", len(df_h2h))
+
+    df_h2h_pagina = paginacao(df_h2h, "grade_h2h", tamanho_pagina)
+
+    gb_h2h = GridOptionsBuilder.from_dataframe(df_h2h_pagina)
+    gb_h2h.configure_default_column(resizable=True, sortable=False, filter=False)
+    grid_h2h = gb_h2h.build()
+
+    custom_css_h2h = {
+        ".ag-header-cell-text": {
+            "font-weight": "bold",
+            "color": "black"
+        }
+    }
+
+    AgGrid(df_h2h_pagina, gridOptions=grid_h2h, height=500, custom_css=custom_css_h2h)
+    diagnostico.marcar("Tabela H2H (AgGrid)", len(df_h2h))
+
+    # Exportação da análise
+    botao_exportacao(
+        df_h2h, "📥 Baixar Análise Head to Head",
+        "analise_head_to_head" if nivel_h2h == "Fazenda" else f"analise_head_to_head_{nivel_h2h.lower()}",
+        "H2H", key="exp_h2h"
+    )
+    diagnostico.marcar("Exportação: H2H", len(df_h2h))
+
+
+@secao
+def secao_ranking(resultado, tamanho_pagina, diagnostico):
+    """Ranking de todos os cultivares contra o painel inteiro."""
+    st.markdown("## 🏆 Ranking dos Cultivares")
+    st.markdown("""
+    <small>
+    Força de cada cultivar ajustada a todas as comparações por local ao mesmo tempo (modelo de Bradley-Terry;
+    empate vale meia vitória). <b>% Vitória vs Média</b> é a chance estimada de vencer um cultivar de força média;
+    <b>Num_Locais</b> e <b>Adversarios</b> mostram em quanto dado a posição se apoia.
+    </small>
+    """, unsafe_allow_html=True)
+
+    ranking = resultado.ranking()
+    diagnostico.marcar("Ranking (Bradley-Terry)", len(ranking))
+
+    minimo_locais = st.number_input("Mínimo de locais", min_value=1, value=1, step=1, key="ranking_minimo_locais")
+    ranking = ranking[ranking["Num_Locais"] >= minimo_locais]
+
+    # Paginação fora das colunas abaixo (colunas só se aninham um nível)
+    ranking_pagina = paginacao(ranking, "grade_ranking", tamanho_pagina)
+
+    col_tabela, col_grafico = st.columns([1.6, 1.4])
+    with col_tabela:
+        gb = GridOptionsBuilder.from_dataframe(ranking_pagina)
+        gb.configure_default_column(resizable=True, sortable=False, filter=False)
+        AgGrid(ranking_pagina, gridOptions=gb.build(), height=400, custom_css={
+            ".ag-header-cell-text": {"font-weight": "bold", "color": "black"}
+        })
+        botao_exportacao(ranking, "📥 Baixar Ranking", "ranking_cultivares", "Ranking", key="exp_ranking")
+
+    with col_grafico:
+        melhores = ranking.head(LIMITE_BARRAS_LOCAL // 2).iloc[::-1]
+        fig_ranking = go.Figure(go.Bar(
+            y=melhores["Cultivar"],
+            x=melhores["% Vitória vs Média"],
+            orientation='h',
+            text=melhores["% Vitória vs Média"].round(1),
+            textposition="outside",
+            marker_color="#01B8AA"
+        ))
+        fig_ranking.update_layout(
+            title=dict(text=f"🏆 Top {len(melhores)} - % Vitória vs Média", font=dict(size=20, family="Arial Black", color="black")),
+            xaxis=dict(range=[0, 105], tickfont=dict(size=14, color="black")),
+            yaxis=dict(tickfont=dict(size=14, color="black")),
+            margin=dict(t=40, b=40, l=60, r=30),
+            height=400 + 10 * len(melhores),
+            showlegend=False
+        )
+        st.plotly_chart(fig_ranking, use_container_width=True)
+    diagnostico.marcar("Ranking (tabela e gráfico)", len(ranking))
+
+
+@secao
+def secao_comparacao(resultado, df, reamostragens, tamanho_pagina, diagnostico):
+    """Comparação de um par: tabela, cartões, intervalos, pizza e gráfico por local."""
+    st.markdown("### 🔹 Selecione os cultivares para comparação Head to Head")
+    cultivares_unicos = resultado.cultivares
+
+    col1, col2, col3 = st.columns([0.3, 0.4, 0.3])
+
+    with col1:
+        head_select = st.selectbox("Selecionar Cultivar Head", options=cultivares_unicos, key="head_select")
+    with col2:
+        st.markdown("<h1 style='text-align: center;'>X</h1>", unsafe_allow_html=True)
+    with col3:
+        check_select = st.selectbox("Selecionar Cultivar Check", options=cultivares_unicos, key="check_select")
+
+
+    if head_select and check_select and head_select != check_select:
+        df_selecionado = resultado.par(head_select, check_select)
+
+        st.markdown(f"### 📋 Tabela Head to Head: <b>{head_select} x {check_select}</b>", unsafe_allow_html=True)
+
+        if not df_selecionado.empty:
+            df_h2h_fmt = df_selecionado.copy()
+
+            # Estilo condicional
+            cell_style_js = JsCode("""
+            function(params) {
+                let value = params.value;
+                let min = 0;
+                let max = 100;
+                let ratio = (value - min) / (max - min);
+
+                let r, g, b;
+                if (ratio < 0.5) {
+                    r = 253;
+                    g = 98 + ratio * 2 * (200 - 98);
+                    b = 94 + ratio * 2 * (15 - 94);
+                } else {
+                    r = 242 - (ratio - 0.5) * 2 * (242 - 1);
+                    g = 200 - (ratio - 0.5) * 2 * (200 - 184);
+                    b = 15 + (ratio - 0.5) * 2 * (170 - 15);
+                }
 
+                return {
+                    'backgroundColor': 'rgb(' + r + ',' + g + ',' + b + ')',
+                    'color': 'black',
+                    'fontWeight': 'bold',
+                    'fontSize': '16px'
+                }
+            }
+            """)
 
-st.set_page_config(layout="wide")
-st.title("⚔️ Análise Head to Head via Excel")
-st.markdown("Carregue um arquivo Excel com as colunas **Local**, **Material**, **Produtividade** (sc/ha) e os filtros desejados.")
+            df_h2h_fmt_pagina = paginacao(df_h2h_fmt, "grade_comparacao", tamanho_pagina)
+
+            gb = GridOptionsBuilder.from_dataframe(df_h2h_fmt_pagina)
+            for col in df_h2h_fmt_pagina.select_dtypes(include=["float"]).columns:
+                if col in ["Head_Mean", "Check_Mean"]:
+                    gb.configure_column(col, type=["numericColumn"], valueFormatter="x.toFixed(1)", cellStyle=cell_style_js)
+                else:
+                    gb.configure_column(col, type=["numericColumn"], valueFormatter="x.toFixed(1)")
+            gb.configure_default_column(cellStyle={'fontSize': '14px'}, sortable=False, filter=False)
+            gb.configure_grid_options(headerHeight=30)
+
+            custom_css = {
+                ".ag-header-cell-label": {
+                    "font-weight": "bold",
+                    "font-size": "15px",
+                    "color": "black"
+                }
+            }
+
+            AgGrid(
+                df_h2h_fmt_pagina,
+                gridOptions=gb.build(),
+                height=500,
+                custom_css=custom_css,
+                allow_unsafe_jscode=True
+            )
+            diagnostico.marcar("Tabela do par (AgGrid)", len(df_h2h_fmt))
+
+            # Exportar comparação Head to Head
+            botao_exportacao(
+                df_h2h_fmt, "📥 Baixar Comparação Head to Head",
+                f"comparacao_{head_select}_vs_{check_select}", "Comparacao_H2H", key="exp_comparacao"
+            )
+            diagnostico.marcar("Exportação: par", len(df_h2h_fmt))
+
+            # 📊 Estatísticas e gráfico de pizza
+            if "Fazenda" in df_selecionado.columns:
+                totais = resultado.totais_par(head_select, check_select)
+                num_locais = totais["Num_Locais"]
+                vitorias = totais["Vitorias"]
+                derrotas = totais["Derrotas"]
+                empates = totais["Empates"]
+
+                max_diff = df_selecionado["Difference (sc/ha)"].max() or 0
+                min_diff = df_selecionado["Difference (sc/ha)"].min() or 0
+                # Vitória e derrota pela margem de empate escolhida
+                derrota = (df_selecionado["Vitória"] == 0) & (df_selecionado["Empate"] == 0)
+                media_diff_vitorias = df_selecionado[df_selecionado["Vitória"] == 1]["Difference (sc/ha)"].mean() or 0
+                media_diff_derrotas = df_selecionado[derrota]["Difference (sc/ha)"].mean() or 0
+
+                # Cards
+                col4, col5, col6, col7 = st.columns(4)
+                with col4:
+                    st.markdown(f"""
+                        <div style="background-color:#f2f2f2; padding:15px; border-radius:10px; text-align:center;">
+                            <h5 style="font-weight:bold; color:#333;">📍 Número de Locais</h5>
+                            <h2 style="margin: 10px 0; color:#333; font-weight:bold; font-size: 4em;">{num_locais}</h2>
+                        </div>
+                    """, unsafe_allow_html=True)
+
+                with col5:
+                    st.markdown(f"""
+                        <div style="background-color:#01B8AA80; padding:15px; border-radius:10px; text-align:center;">
+                            <h5 style="font-weight:bold; color:#004d47;">✅ Vitórias</h5>
+                            <div style="font-size: 20px;">Max: {max_diff:.1f} sc/ha</div>
+                            <h2 style="margin: 10px 0; color:#004d47; font-weight:bold; font-size: 4em;">{vitorias}</h2>
+                            <div style="font-size: 20px;">Média: {media_diff_vitorias:.1f} sc/ha</div>
+                        </div>
+                    """, unsafe_allow_html=True)
+
+                with col6:
+                    st.markdown(f"""
+                        <div style="background-color:#F2C80F80; padding:15px; border-radius:10px; text-align:center;">
+                            <h5 style="font-weight:bold; color:#8a7600;">➖ Empates</h5>
+                            <h2 style="margin: 10px 0; color:#8a7600; font-weight:bold; font-size: 4em;">{empates}</h2>
+                        </div>
+                    """, unsafe_allow_html=True)
+
+                with col7:
+                    st.markdown(f"""
+                        <div style="background-color:#FD625E80; padding:15px; border-radius:10px; text-align:center;">
+                            <h5 style="font-weight:bold; color:#7c1f1c;">❌ Derrotas</h5>
+                            <div style="font-size: 20px;">Min: {min_diff:.1f} sc/ha</div>
+                            <h2 style="margin: 10px 0; color:#7c1f1c; font-weight:bold; font-size: 4em;">{derrotas}</h2>
+                            <div style="font-size: 20px;">Média: {media_diff_derrotas:.1f} sc/ha</div>
+                        </div>
+                    """, unsafe_allow_html=True)
+
+                # Incerteza: poucos locais deixam diferença e % de vitórias pouco confiáveis
+                ic = resultado.intervalos([(head_select, check_select)], reamostragens).iloc[0]
+                st.markdown(
+                    f"📏 **IC {CONFIANCA:.0%}** (bootstrap por local, {reamostragens} reamostragens): "
+                    f"diferença média de **{ic['Dif_IC_Inf']:.1f} a {ic['Dif_IC_Sup']:.1f} sc/ha** · "
+                    f"vitórias de **{ic['Vit_IC_Inf']:.1f}% a {ic['Vit_IC_Sup']:.1f}%**"
+                )
+
+                # Quanto o resultado depende da margem de empate
+                with st.expander("📈 Vitórias por margem de empate"):
+                    limiar, relativo = resultado.limiar
+                    unidade = "% do check" if relativo else "sc/ha"
+                    varredura = resultado.varredura(head_select, check_select)
+                    fig_varredura = go.Figure([
+                        go.Scatter(x=varredura["Limiar"], y=varredura[coluna], name=coluna, mode="lines", line=dict(color=cor, width=3))
+                        for coluna, cor in [("% Vitórias", "#01B8AA"), ("% Empates", "#F2C80F"), ("% Derrotas", "#FD625E")]
+                    ])
+                    fig_varredura.add_vline(x=limiar, line_dash="dash", annotation_text=f"Atual: ±{limiar:g} {unidade}")
+                    fig_varredura.update_layout(
+                        xaxis=dict(title=dict(text=f"Margem de empate ({unidade})")),
+                        yaxis=dict(title=dict(text="% dos locais"), range=[0, 100]),
+                        margin=dict(t=30, b=40, l=60, r=30),
+                        height=350
+                    )
+                    st.plotly_chart(fig_varredura, use_container_width=True)
+
+                # 🎯 Pizza
+                col_p1, col_p2, col_p3 = st.columns([1, 2, 1])
+                with col_p2:
+                    st.markdown("""
+                        <div style="background-color: #f9f9f9; padding: 10px; border-radius: 12px; 
+                                    box-shadow: 0px 2px 5px rgba(0,0,0,0.1); text-align: center;">
+                            <h4 style="margin-bottom: 0.5rem;">Resultado Geral do Head</h4>
+                    """, unsafe_allow_html=True)
+
+                    fig_pizza = go.Figure(data=[go.Pie(
+                        labels=["Vitórias", "Empates", "Derrotas"],
+                        values=[vitorias, empates, derrotas],
+                        marker=dict(colors=["#01B8AA", "#F2C80F", "#FD625E"]),
+                        hole=0.6,
+                        textinfo='label+percent',
+                        textposition='outside',
+                        textfont=dict(size=20, color="black", family="Arial Black"),
+                    )])
+
+                    fig_pizza.update_layout(
+                        margin=dict(t=10, b=60, l=10, r=10),
+                        height=280,
+                        showlegend=False
+                    )
+
+                    st.plotly_chart(fig_pizza, use_container_width=True)
+                    st.markdown("</div>", unsafe_allow_html=True)
+                diagnostico.marcar("Cartões, pizza e IC", int(num_locais))
+
+        else:
+            st.warning("⚠️ Nenhum dado disponível para essa comparação.")
+
+
+
+
+        # 📊 Gráfico Diferença por Local
+        st.markdown(f"### <b>📊 Diferença de Produtividade por Local - {head_select} X {check_select}</b>", unsafe_allow_html=True)
+
+        df_validos = df_selecionado[
+            (df_selecionado["Head_Mean"] > 0) &
+            (df_selecionado["Check_Mean"] > 0)
+        ].copy()
+
+        df_validos = df_validos.sort_values("Difference (sc/ha)")
+
+        # Local é Fazenda e Safra: a safra entra no rótulo quando a mesma fazenda aparece em mais de uma
+        df_validos["Local"] = df_validos["Fazenda"].astype(str)
+        if "Safra" in df_validos.columns and df_validos["Fazenda"].duplicated().any():
+            df_validos["Local"] += " · " + df_validos["Safra"].astype(str)
+
+        # Com muitos locais o gráfico é resumido, para que seu tamanho não cresça com o número de fazendas
+        df_grafico, coluna_rotulo, titulo_eixo = df_validos, "Local", "Local"
+        modo_grafico = "Por local"
+        if len(df_validos) > LIMITE_BARRAS_LOCAL:
+            niveis = {
+                f"Média por {label}": coluna
+                for coluna, label in [("Microrregiao", "Microrregião"), ("Estado", "Estado")]
+                if coluna in df.columns
+            }
+            st.caption(f"ℹ️ {len(df_validos)} locais: acima de {LIMITE_BARRAS_LOCAL} o gráfico é resumido.")
+            modo_grafico = st.radio(
+                "Visualização", [*niveis, "Distribuição", "Melhores e piores locais"],
+                horizontal=True, key="modo_grafico_local"
+            )
+
+            if modo_grafico in niveis:
+                coluna_rotulo = titulo_eixo = niveis[modo_grafico]
+                df_grafico = diferencas_por_grupo(df_validos, df, coluna_rotulo)
+                if len(df_grafico) > LIMITE_BARRAS_LOCAL:
+                    df_grafico = extremos(df_grafico, "Difference (sc/ha)", LIMITE_BARRAS_LOCAL // 2)
+                    st.caption(f"Mostrando os {LIMITE_BARRAS_LOCAL // 2} grupos de maior e de menor diferença.")
+            elif modo_grafico == "Melhores e piores locais":
+                # Limites válidos mesmo com H2H_LIMITE_BARRAS_LOCAL pequeno
+                maximo_extremos = max(6, LIMITE_BARRAS_LOCAL // 2)
+                n_extremos = st.slider("Locais em cada ponta", 5, maximo_extremos, min(10, maximo_extremos), key="n_extremos_local")
+                df_grafico = extremos(df_validos, "Difference (sc/ha)", n_extremos)
+
+        if modo_grafico == "Distribuição":
+            faixas = histograma_diferencas(df_validos["Difference (sc/ha)"])
+            fig_diff_local = go.Figure(go.Bar(
+                x=faixas["Centro"],
+                y=faixas["Locais"],
+                width=faixas["Largura"],
+                marker_color=cores_diferenca(faixas["Centro"], resultado.margem([df_validos["Check_Mean"].mean()] * len(faixas))),
+                hovertemplate="Diferença ≈ %{x:.1f} sc/ha<br>Locais: %{y}<extra></extra>"
+            ))
+            fig_diff_local.update_layout(
+                title=dict(
+                    text=f"<b>📍 Distribuição da Diferença entre Locais — {head_select} X {check_select}</b>",
+                    font=dict(size=20, family="Arial Black", color="black")
+                ),
+                xaxis=dict(
+                    title=dict(text="<b>Diferença (sc/ha)</b>", font=dict(size=20, color="black")),
+                    tickfont=dict(size=20, color="black")
+                ),
+                yaxis=dict(
+                    title=dict(text="<b>Locais</b>", font=dict(size=20, color="black")),
+                    tickfont=dict(size=20, color="black")
+                ),
+                margin=dict(t=40, b=40, l=100, r=40),
+                height=600,
+                showlegend=False
+            )
+        else:
+            # Cores com base na diferença e na margem de empate
+            cores_local = cores_diferenca(df_grafico["Difference (sc/ha)"], resultado.margem(df_grafico["Check_Mean"]))
+
+            fig_diff_local = go.Figure()
+            fig_diff_local.add_trace(go.Bar(
+                y=df_grafico[coluna_rotulo],  # Análise por Fazenda (ou grupo de fazendas)
+                x=df_grafico["Difference (sc/ha)"],
+                orientation='h',
+                text=df_grafico["Difference (sc/ha)"].round(1),
+                textposition="outside",
+                textfont=dict(size=20, family="Arial Black", color="black"),
+                marker_color=cores_local
+            ))
+
+            fig_diff_local.update_layout(
+                title=dict(
+                    text=f"<b>📍 Diferença de Produtividade por {titulo_eixo} — {head_select} X {check_select}</b>",
+                    font=dict(size=20, family="Arial Black", color="black")  # Título preto
+                ),
+                xaxis=dict(
+                    title=dict(text="<b>Diferença (sc/ha)</b>", font=dict(size=20, color="black")),
+                    tickfont=dict(size=20, color="black")
+                ),
+                yaxis=dict(
+                    title=dict(text=f"<b>{titulo_eixo}</b>", font=dict(size=20, color="black")),
+                    tickfont=dict(size=20, color="black")
+                ),
+                margin=dict(t=40, b=40, l=100, r=40),
+                height=600,
+                showlegend=False
+            )
+
+
+        st.plotly_chart(fig_diff_local, use_container_width=True)
+        diagnostico.marcar(f"Gráfico por local (plotly, {modo_grafico})", len(df_validos))
+
+
+@secao
+def secao_multi_check(resultado, reamostragens, diagnostico):
+    """Comparação de um Head com vários Checks."""
+    cultivares_unicos = resultado.cultivares
+
+    # 🔀 Comparação Multichecks
+    st.markdown("### 🔹 Comparação Head x Múltiplos Checks")
+    st.markdown("""
+    <small>
+    Essa análise permite comparar um cultivar (Head) com vários outros (Checks) ao mesmo tempo. 
+    Ela apresenta o percentual de vitórias, produtividade média e a diferença média de performance 
+    em relação aos demais cultivares selecionados.
+    </small>
+    """, unsafe_allow_html=True)
+
+    head_unico = st.selectbox("Cultivar Head", options=cultivares_unicos, key="multi_head")
+    opcoes_checks = [c for c in cultivares_unicos if c != head_unico]
+    checks_selecionados = st.multiselect("Cultivares Check", options=opcoes_checks, key="multi_checks")
+
+    if head_unico and checks_selecionados:
+        resumo = resultado.resumo(head_unico, checks_selecionados, reamostragens)
+
+        if not resumo.empty:
+            prod_head_media = resultado.media_head(head_unico, checks_selecionados).round(1)
+
+            st.markdown(f"#### 🎯 Cultivar Head: **{head_unico}** | Produtividade Média: **{prod_head_media} sc/ha**")
+
+            col_tabela, col_grafico = st.columns([1.4, 1.6])
+
+            with col_tabela:
+                st.markdown("### 📊 Tabela Comparativa")
+                gb = GridOptionsBuilder.from_dataframe(resumo)
+                gb.configure_default_column(cellStyle={'fontSize': '14px'})
+                gb.configure_grid_options(headerHeight=30)
+                custom_css = {
+                    ".ag-header-cell-label": {
+                        "font-weight": "bold",
+                        "font-size": "15px",
+                        "color": "black"
+                    }
+                }
+
+                AgGrid(resumo, gridOptions=gb.build(), height=400, custom_css=custom_css)
+
+                # Exportação
+                botao_exportacao(
+                    resumo, "📅 Baixar Comparação", f"comparacao_{head_unico}_vs_checks",
+                    "comparacao_multi_check", key="exp_multi"
+                )
+
+            with col_grafico:
+                fig_diff = go.Figure()
+                cores_personalizadas = cores_diferenca(resumo["Diferença Média"], resultado.margem(resumo["Prod_sc_ha_media"]))
+
+                fig_diff.add_trace(go.Bar(
+                    y=resumo["Cultivar Check"],
+                    x=resumo["Diferença Média"],
+                    orientation='h',
+                    text=resumo["Diferença Média"].round(1),
+                    textposition="outside",
+                    textfont=dict(size=16, family="Arial Black", color="black"),
+                    marker_color=cores_personalizadas
+                ))
 
-uploaded_file = st.file_uploader("📁 Faça upload do arquivo Excel", type=["xlsx"])
+                fig_diff.update_layout(
+                    title=dict(text="📊 Diferença Média de Produtividade", font=dict(size=20, family="Arial Black", color="black")),
+                    xaxis=dict(title=dict(text="Diferença Média (sc/ha)", font=dict(size=16, color="black")), tickfont=dict(size=14, color="black")),
+                    yaxis=dict(title=dict(text="Check", font=dict(size=14, color="black")), tickfont=dict(size=14, color="black")),
+                    margin=dict(t=30, b=40, l=60, r=30),
+                    height=400,
+                    showlegend=False
+                )
 
-if uploaded_file is not None:
-    df = pd.read_excel(uploaded_file)
+                st.plotly_chart(fig_diff, use_container_width=True)
+            diagnostico.marcar("Multi-check", len(resumo))
+        else:
+            st.info("❓ Nenhuma comparação disponível com os Checks selecionados.")
+
+
+@secao
+def secao_relatorio(resultado, diagnostico):
+    """Relatório em lote (xlsx com várias abas), gerado em segundo plano."""
+    st.markdown("### 📑 Relatório em Lote")
+    st.markdown("""
+    <small>
+    Um único Excel com o ranking, o resumo de todos os pares dos heads escolhidos, uma aba por head
+    (tabela contra cada check e gráfico) e as comparações por local. É gerado em segundo plano:
+    o restante do app continua disponível enquanto isso.
+    </small>
+    """, unsafe_allow_html=True)
+
+    heads = st.multiselect("Heads do relatório (vazio: todos)", resultado.cultivares, key="relatorio_heads")
+    tarefa = st.session_state.get("relatorio_tarefa")
+    gerando = tarefa is not None and not tarefa.pronta()
+
+    if st.button("📑 Gerar relatório", key="relatorio_gerar", disabled=gerando):
+        st.session_state["relatorio_tarefa"] = Tarefa(gerar_relatorio, resultado, heads)
+        # Execução completa, para o acompanhamento do progresso começar
+        st.rerun()
+
+    if tarefa is not None and tarefa.pronta():
+        try:
+            dados = tarefa.resultado()
+        except Exception as erro:  # erro da thread do relatório, mostrado aqui
+            st.error(f"❌ Não foi possível gerar o relatório: {erro}")
+        else:
+            st.download_button(
+                "📥 Baixar relatório", data=dados, file_name="relatorio_head_to_head.xlsx",
+                mime=FORMATOS_EXPORTACAO["Excel"][1], key="relatorio_baixar", on_click="ignore"
+            )
+    diagnostico.marcar("Relatório em lote", len(heads))
 
-    df.rename(columns={
-        "Material": "Cultivar",
-        "Produtividade": "prod_sc_ha"
-    }, inplace=True)
 
-    # Converte produtividade
-    df["prod_sc_ha"] = pd.to_numeric(df["prod_sc_ha"], errors="coerce")
+def acompanhar_relatorio():
+    """Barra de progresso do relatório; reexecutada sozinha (fragmento) até ele terminar."""
+    tarefa = st.session_state["relatorio_tarefa"]
+    if tarefa.pronta():
+        # Execução completa: mostra o botão de download e encerra o acompanhamento
+        st.rerun()
+    st.progress(tarefa.fracao(), text=f"📑 Gerando relatório: {tarefa.feitos}/{tarefa.total} abas")
 
-    # Remove linhas com prod inválido
-    df = df[df["prod_sc_ha"] > 0]
 
-    # Garante que todas as colunas visíveis estão presentes
-    colunas_necessarias = [
-        "Fazenda", "Produtor", "Cidade", "Microrregiao", "Estado", "UF",
-        "Plantio", "Colheita", "Cultivar", "GM",
-        "Pop_Final", "Umidade (%)", "prod_kg_ha", "prod_sc_ha",
-        "Safra"
+def cores_diferenca(diferencas, margens):
+    """Cor de cada diferença: vitória acima da margem de empate, derrota abaixo de -margem, empate entre elas."""
+    return [
+        "#01B8AA" if dif > margem else "#FD625E" if dif < -margem else "#F2C80F"
+        for dif, margem in zip(diferencas, margens)
     ]
 
-    colunas_disponiveis = [col for col in colunas_necessarias if col in df.columns]
 
-    # Subseta só com colunas disponíveis (mas só depois do filtro acima)
-    df = df[colunas_disponiveis].dropna()
+st.set_page_config(layout="wide")
+
+# Tempo (e, opcionalmente, memória) de cada etapa desta execução
+with st.sidebar:
+    mostrar_diagnostico = st.toggle("🩺 Diagnóstico de desempenho", key="mostrar_diagnostico")
+    medir_memoria = mostrar_diagnostico and st.checkbox("Medir memória (deixa o app mais lento)")
+diagnostico = Diagnostico(memoria=medir_memoria)
+st.title("⚔️ Análise Head to Head via Excel")
+st.markdown("Carregue um arquivo Excel com as colunas **Local**, **Material**, **Produtividade** (sc/ha) e os filtros desejados.")
 
+fonte = st.radio("Fonte dos dados", ["📁 Arquivo Excel", "🗄️ Base Parquet"], horizontal=True)
+
+dados = None
+# Colunas já filtradas na leitura da base; não se repetem nos filtros abaixo
+filtradas_na_leitura = []
+
+if fonte == "📁 Arquivo Excel":
+    uploaded_file = st.file_uploader("📁 Faça upload do arquivo Excel", type=["xlsx"])
+
+    if uploaded_file is not None:
+        try:
+            dados = carregar_excel(uploaded_file.getvalue())
+        except ErroIngestao as erro:
+            st.error(f"❌ {erro}")
+            st.stop()
+
+        if st.button("💾 Adicionar à base Parquet"):
+            n_linhas = adicionar_dataset(uploaded_file.getvalue())
+            st.success(f"✅ {n_linhas} linhas adicionadas à base (por Safra e Estado).")
+else:
+    # Só as safras e estados escolhidos são lidos do disco
+    particoes = particoes_dataset()
+    if not any(particoes.values()):
+        st.info("ℹ️ A base Parquet está vazia. Carregue um Excel e use **💾 Adicionar à base Parquet**.")
+    else:
+        filtros_leitura = {}
+        for coluna, col_particao in zip(COLUNAS_PARTICAO, st.columns(len(COLUNAS_PARTICAO))):
+            with col_particao:
+                filtros_leitura[coluna] = st.multiselect(
+                    f"{coluna} (base)", particoes[coluna], default=particoes[coluna], key=f"base_{coluna}",
+                    format_func=rotulo_opcao
+                )
+        dados = carregar_dataset(filtros_leitura)
+        filtradas_na_leitura = COLUNAS_PARTICAO
 
+if dados is not None:
+    diagnostico.marcar("Leitura dos dados", len(dados.df))
+    df = dados.df
     st.success("✅ Dados carregados e formatados!")
 
     # Layout com coluna de filtros (15%) e tabela (85%)
@@ -55,17 +731,24 @@ if uploaded_file is not None:
             "Cidade": "Cidade"
         }
 
+        # Seleções combinadas numa única máscara; opções em cascata vêm do índice
+        mascara = None
+
         for coluna, label in filtros_expander.items():
-            if coluna in df.columns:
+            if coluna in df.columns and coluna not in filtradas_na_leitura:
                 with st.expander(f"{label}"):
-                    opcoes = df[coluna].dropna().unique().tolist()
-                    selecionados = st.multiselect(f"Selecionar {label}", opcoes, default=opcoes)
-                    df = df[df[coluna].isin(selecionados)]
+                    opcoes = dados.opcoes(coluna, mascara)
+                    selecionados = st.multiselect(
+                        f"Selecionar {label}", opcoes, default=opcoes,
+                        format_func=rotulo_opcao
+                    )
+                    mascara = dados.restringir(mascara, coluna, selecionados)
 
         # Filtro por Slider - GM
-        if "GM" in df.columns:
-            min_gm = int(df["GM"].min())
-            max_gm = int(df["GM"].max())
+        faixa_gm = dados.faixa("GM", mascara) if "GM" in df.columns else None
+        if faixa_gm is not None:
+            min_gm = int(faixa_gm[0])
+            max_gm = int(faixa_gm[1])
             if min_gm == max_gm:
                 st.info(f"Apenas um valor de GM disponível: {min_gm}")
             else:
@@ -77,7 +760,30 @@ if uploaded_file is not None:
                         value=(min_gm, max_gm),
                         step=1
                     )
-                    df = df[(df["GM"] >= range_gm[0]) & (df["GM"] <= range_gm[1])]
+                    mascara = dados.restringir_faixa(mascara, "GM", range_gm[0], range_gm[1])
+
+        df = dados.filtrar(mascara)
+        diagnostico.marcar("Filtros", len(df))
+
+        st.markdown("### ⚙️ Exibição")
+        # Padrões vindos do ambiente ficam dentro dos limites do widget, que senão levanta erro
+        tamanho_pagina = st.number_input(
+            "Linhas por página", min_value=10, max_value=5000, value=min(max(LINHAS_POR_PAGINA, 10), 5000), step=10
+        )
+        reamostragens = st.number_input(
+            f"Reamostragens bootstrap (IC {CONFIANCA:.0%})", min_value=100, max_value=20000,
+            value=min(max(REAMOSTRAGENS, 100), 20000), step=100
+        )
+        # Trocar a margem só reclassifica os pares já calculados
+        tipo_margem = st.radio("Margem de empate", ["sc/ha", "% do check"], horizontal=True)
+        relativo = tipo_margem == "% do check"
+        limiar = st.number_input(
+            f"Empate até ± ({tipo_margem})", min_value=0.0, max_value=50.0, value=min(max(LIMIAR_EMPATE, 0.0), 50.0), step=0.1
+        )
+        paralelo = PROCESSOS > 1 and st.toggle(
+            f"⚡ Cálculo paralelo ({PROCESSOS} processos)",
+            help="Divide as fazendas entre processos no primeiro cálculo. Vale a pena em bases muito grandes."
+        )
 
     with col_tabela:
         st.markdown("## 📋 Tabela com Filtros Aplicados")
@@ -94,473 +800,55 @@ if uploaded_file is not None:
 
         df_exibicao = df[colunas_presentes].copy()
 
-        gb = GridOptionsBuilder.from_dataframe(df_exibicao)
-        gb.configure_default_column(resizable=True, sortable=True, filter=True)
-        grid_options = gb.build()
+        # A análise usa a média das parcelas de cada cultivar por Safra e Fazenda
+        if st.toggle("🔁 Agregar repetições (média por Safra, Fazenda e Cultivar)", key="agregar_repeticoes"):
+            chaves = ["Safra", "Fazenda", "Cultivar", "prod_sc_ha"]
+            df_exibicao = agregar_repeticoes(df[[col for col in df.columns if col in colunas_presentes or col in chaves]])
+            diagnostico.marcar("Agregação das repetições", len(df_exibicao))
 
-        custom_css = {
-            ".ag-header-cell-text": {
-                "font-weight": "bold",
-                "color": "black"
-            }
-        }
-
-        AgGrid(
-            df_exibicao,
-            gridOptions=grid_options,
-            height=500,
-            custom_css=custom_css
-        )
-
-        # Exportar para Excel
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-            df_exibicao.to_excel(writer, index=False, sheet_name="Tabela Filtrada")
-        buffer.seek(0)
-
-        st.download_button(
-            label="📥 Baixar Excel com Filtros",
-            data=buffer,
-            file_name="tabela_filtrada.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        secao_tabela_filtrada(df_exibicao, tamanho_pagina, diagnostico=diagnostico)
 
         # Análise Head to Head
 
         # Botão para rodar análise Head to Head
         if st.button("🔁 Rodar Análise Head to Head"):
-            resultados_h2h = []
-
-            for fazenda, grupo in df_exibicao.groupby("Fazenda"):
-                cultivares = grupo["Cultivar"].unique()
-
-                for head in cultivares:
-                    prod_head = grupo.loc[grupo["Cultivar"] == head, "prod_sc_ha"].values[0]
-
-                    for check in cultivares:
-                        if head == check:
-                            continue
-                        prod_check = grupo.loc[grupo["Cultivar"] == check, "prod_sc_ha"].values[0]
-                        diff = prod_head - prod_check
-                        win = int(diff > 1)
-                        draw = int(-1 <= diff <= 1)
-
-                        resultados_h2h.append({
-                            "Fazenda": fazenda,
-                            "Head": head,
-                            "Check": check,
-                            "Head_Mean": round(prod_head, 1),
-                            "Check_Mean": round(prod_check, 1),
-                            "Difference (sc/ha)": round(diff, 1),
-                            "Vitória": win,
-                            "Empate": draw,
-                            "% Vitória": 100.0 if win else 0.0
-                        })
-
-            df_h2h = pd.DataFrame(resultados_h2h)
-
-            if not df_h2h.empty:
-                st.session_state["h2h_resultado"] = df_h2h
+            # Sem execução anterior na sessão, parte do resultado pré-calculado (python -m h2h), se houver
+            anterior = st.session_state.get("h2h_resultado")
+            if anterior is None:
+                anterior = abrir_precalculado(assinatura_df(dados.df))
+            if paralelo and anterior is None:
+                barra = st.progress(0.0, text="⚡ Calculando pares em paralelo...")
+                resultado = ResultadoH2H(
+                    df, processos=PROCESSOS,
+                    progresso=lambda feitos, total: barra.progress(feitos / total, text=f"⚡ Blocos de fazendas: {feitos}/{total}")
+                )
+                barra.empty()
+            else:
+                resultado = ResultadoH2H(df, anterior=anterior)
+            diagnostico.marcar("Pares H2H", len(resultado))
+
+            if len(resultado):
+                st.session_state["h2h_resultado"] = resultado
                 st.success("✅ Análise Head to Head concluída com sucesso!")
             else:
                 st.warning("⚠️ Nenhuma comparação gerada com os dados atuais.")
 
         if "h2h_resultado" in st.session_state:
-            st.markdown("## 📊 Resultado Head to Head")
-
-            df_h2h = st.session_state["h2h_resultado"]
-
-            gb_h2h = GridOptionsBuilder.from_dataframe(df_h2h)
-            gb_h2h.configure_default_column(resizable=True, sortable=True, filter=True)
-            grid_h2h = gb_h2h.build()
-
-            custom_css_h2h = {
-                ".ag-header-cell-text": {
-                    "font-weight": "bold",
-                    "color": "black"
-                }
-            }
-
-            AgGrid(df_h2h, gridOptions=grid_h2h, height=500, custom_css=custom_css_h2h)
-
-            # Exportação da análise
-            buffer_h2h = io.BytesIO()
-            with pd.ExcelWriter(buffer_h2h, engine="xlsxwriter") as writer:
-                df_h2h.to_excel(writer, index=False, sheet_name="H2H")
-            buffer_h2h.seek(0)
-
-            st.download_button(
-                label="📥 Baixar Análise Head to Head",
-                data=buffer_h2h,
-                file_name="analise_head_to_head.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
-
-        from st_aggrid import JsCode  # garante que esse import esteja no topo
-
-        if "h2h_resultado" in st.session_state:
-            df_resultado = st.session_state["h2h_resultado"]
-
-            df_resultado_filtrado = df_resultado.copy()
-
-            st.markdown("### 🔹 Selecione os cultivares para comparação Head to Head")
-            cultivares_unicos = sorted(df_resultado_filtrado["Head"].unique())
-
-            col1, col2, col3 = st.columns([0.3, 0.4, 0.3])
-
-            with col1:
-                head_select = st.selectbox("Selecionar Cultivar Head", options=cultivares_unicos, key="head_select")
-            with col2:
-                st.markdown("<h1 style='text-align: center;'>X</h1>", unsafe_allow_html=True)
-            with col3:
-                check_select = st.selectbox("Selecionar Cultivar Check", options=cultivares_unicos, key="check_select")
-
-
-            if head_select and check_select and head_select != check_select:
-                df_selecionado = df_resultado_filtrado[
-                    (df_resultado_filtrado["Head"] == head_select) & 
-                    (df_resultado_filtrado["Check"] == check_select)
-                ]
-
-                st.markdown(f"### 📋 Tabela Head to Head: <b>{head_select} x {check_select}</b>", unsafe_allow_html=True)
-
-                if not df_selecionado.empty:
-                    df_h2h_fmt = df_selecionado.copy()
-
-                    # Estilo condicional
-                    cell_style_js = JsCode("""
-                    function(params) {
-                        let value = params.value;
-                        let min = 0;
-                        let max = 100;
-                        let ratio = (value - min) / (max - min);
-
-                        let r, g, b;
-                        if (ratio < 0.5) {
-                            r = 253;
-                            g = 98 + ratio * 2 * (200 - 98);
-                            b = 94 + ratio * 2 * (15 - 94);
-                        } else {
-                            r = 242 - (ratio - 0.5) * 2 * (242 - 1);
-                            g = 200 - (ratio - 0.5) * 2 * (200 - 184);
-                            b = 15 + (ratio - 0.5) * 2 * (170 - 15);
-                        }
-
-                        return {
-                            'backgroundColor': 'rgb(' + r + ',' + g + ',' + b + ')',
-                            'color': 'black',
-                            'fontWeight': 'bold',
-                            'fontSize': '16px'
-                        }
-                    }
-                    """)
-
-                    gb = GridOptionsBuilder.from_dataframe(df_h2h_fmt)
-                    for col in df_h2h_fmt.select_dtypes(include=["float"]).columns:
-                        if col in ["Head_Mean", "Check_Mean"]:
-                            gb.configure_column(col, type=["numericColumn"], valueFormatter="x.toFixed(1)", cellStyle=cell_style_js)
-                        else:
-                            gb.configure_column(col, type=["numericColumn"], valueFormatter="x.toFixed(1)")
-                    gb.configure_default_column(cellStyle={'fontSize': '14px'})
-                    gb.configure_grid_options(headerHeight=30)
-
-                    custom_css = {
-                        ".ag-header-cell-label": {
-                            "font-weight": "bold",
-                            "font-size": "15px",
-                            "color": "black"
-                        }
-                    }
-
-                    AgGrid(
-                        df_h2h_fmt,
-                        gridOptions=gb.build(),
-                        height=500,
-                        custom_css=custom_css,
-                        allow_unsafe_jscode=True
-                    )
-
-                    # Exportar comparação Head to Head
-                    buffer = io.BytesIO()
-                    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-                        df_h2h_fmt.to_excel(writer, index=False, sheet_name="Comparacao_H2H")
-                    buffer.seek(0)
-                    st.download_button(
-                        label="📥 Baixar Comparação Head to Head",
-                        data=buffer,
-                        file_name=f"comparacao_{head_select}_vs_{check_select}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
-
-                    # 📊 Estatísticas e gráfico de pizza
-                    if "Fazenda" in df_selecionado.columns:
-                        num_locais = df_selecionado["Fazenda"].nunique()
-                        vitorias = df_selecionado[df_selecionado["Difference (sc/ha)"] > 1].shape[0]
-                        derrotas = df_selecionado[df_selecionado["Difference (sc/ha)"] < -1].shape[0]
-                        empates = df_selecionado[df_selecionado["Difference (sc/ha)"].between(-1, 1)].shape[0]
-
-                        max_diff = df_selecionado["Difference (sc/ha)"].max() or 0
-                        min_diff = df_selecionado["Difference (sc/ha)"].min() or 0
-                        media_diff_vitorias = df_selecionado[df_selecionado["Difference (sc/ha)"] > 1]["Difference (sc/ha)"].mean() or 0
-                        media_diff_derrotas = df_selecionado[df_selecionado["Difference (sc/ha)"] < -1]["Difference (sc/ha)"].mean() or 0
-
-                        # Cards
-                        col4, col5, col6, col7 = st.columns(4)
-                        with col4:
-                            st.markdown(f"""
-                                <div style="background-color:#f2f2f2; padding:15px; border-radius:10px; text-align:center;">
-                                    <h5 style="font-weight:bold; color:#333;">📍 Número de Locais</h5>
-                                    <h2 style="margin: 10px 0; color:#333; font-weight:bold; font-size: 4em;">{num_locais}</h2>
-                                </div>
-                            """, unsafe_allow_html=True)
-
-                        with col5:
-                            st.markdown(f"""
-                                <div style="background-color:#01B8AA80; padding:15px; border-radius:10px; text-align:center;">
-                                    <h5 style="font-weight:bold; color:#004d47;">✅ Vitórias</h5>
-                                    <div style="font-size: 20px;">Max: {max_diff:.1f} sc/ha</div>
-                                    <h2 style="margin: 10px 0; color:#004d47; font-weight:bold; font-size: 4em;">{vitorias}</h2>
-                                    <div style="font-size: 20px;">Média: {media_diff_vitorias:.1f} sc/ha</div>
-                                </div>
-                            """, unsafe_allow_html=True)
-
-                        with col6:
-                            st.markdown(f"""
-                                <div style="background-color:#F2C80F80; padding:15px; border-radius:10px; text-align:center;">
-                                    <h5 style="font-weight:bold; color:#8a7600;">➖ Empates</h5>
-                                    <h2 style="margin: 10px 0; color:#8a7600; font-weight:bold; font-size: 4em;">{empates}</h2>
-                                </div>
-                            """, unsafe_allow_html=True)
-
-                        with col7:
-                            st.markdown(f"""
-                                <div style="background-color:#FD625E80; padding:15px; border-radius:10px; text-align:center;">
-                                    <h5 style="font-weight:bold; color:#7c1f1c;">❌ Derrotas</h5>
-                                    <div style="font-size: 20px;">Min: {min_diff:.1f} sc/ha</div>
-                                    <h2 style="margin: 10px 0; color:#7c1f1c; font-weight:bold; font-size: 4em;">{derrotas}</h2>
-                                    <div style="font-size: 20px;">Média: {media_diff_derrotas:.1f} sc/ha</div>
-                                </div>
-                            """, unsafe_allow_html=True)
-
-                        # 🎯 Pizza
-                        col_p1, col_p2, col_p3 = st.columns([1, 2, 1])
-                        with col_p2:
-                            st.markdown("""
-                                <div style="background-color: #f9f9f9; padding: 10px; border-radius: 12px; 
-                                            box-shadow: 0px 2px 5px rgba(0,0,0,0.1); text-align: center;">
-                                    <h4 style="margin-bottom: 0.5rem;">Resultado Geral do Head</h4>
-                            """, unsafe_allow_html=True)
-
-                            fig_pizza = go.Figure(data=[go.Pie(
-                                labels=["Vitórias", "Empates", "Derrotas"],
-                                values=[vitorias, empates, derrotas],
-                                marker=dict(colors=["#01B8AA", "#F2C80F", "#FD625E"]),
-                                hole=0.6,
-                                textinfo='label+percent',
-                                textposition='outside',
-                                textfont=dict(size=20, color="black", family="Arial Black"),
-                            )])
-
-                            fig_pizza.update_layout(
-                                margin=dict(t=10, b=60, l=10, r=10),
-                                height=280,
-                                showlegend=False
-                            )
-
-                            st.plotly_chart(fig_pizza, use_container_width=True)
-                            st.markdown("</div>", unsafe_allow_html=True)
-
-                else:
-                    st.warning("⚠️ Nenhum dado disponível para essa comparação.")
-
-
-
-
-                # 📊 Gráfico Diferença por Local
-                st.markdown(f"### <b>📊 Diferença de Produtividade por Local - {head_select} X {check_select}</b>", unsafe_allow_html=True)
-                st.markdown("### 📌 Dica: para melhor visualização dos rótulos, filtre para um número menor de locais.")
-
-                df_validos = df_selecionado[
-                    (df_selecionado["Head_Mean"] > 0) &
-                    (df_selecionado["Check_Mean"] > 0)
-                ].copy()
-
-                df_validos = df_validos.sort_values("Difference (sc/ha)")
-
-                # Cores com base na diferença
-                cores_local = df_validos["Difference (sc/ha)"].apply(
-                    lambda x: "#01B8AA" if x > 1 else "#FD625E" if x < -1 else "#F2C80F"
-                )
-
-                fig_diff_local = go.Figure()
-                fig_diff_local.add_trace(go.Bar(
-                    y=df_validos["Fazenda"],  # Análise por Fazenda
-                    x=df_validos["Difference (sc/ha)"],
-                    orientation='h',
-                    text=df_validos["Difference (sc/ha)"].round(1),
-                    textposition="outside",
-                    textfont=dict(size=20, family="Arial Black", color="black"),
-                    marker_color=cores_local
-                ))
-
-                fig_diff_local.update_layout(
-                    title=dict(
-                        text=f"<b>📍 Diferença de Produtividade por Local — {head_select} X {check_select}</b>",
-                        font=dict(size=20, family="Arial Black", color="black")  # Título preto
-                    ),
-                    xaxis=dict(
-                        title=dict(text="<b>Diferença (sc/ha)</b>", font=dict(size=20, color="black")),
-                        tickfont=dict(size=20, color="black")
-                    ),
-                    yaxis=dict(
-                        title=dict(text="<b>Local</b>", font=dict(size=20, color="black")),
-                        tickfont=dict(size=20, color="black")
-                    ),
-                    margin=dict(t=40, b=40, l=100, r=40),
-                    height=600,
-                    showlegend=False
-                )
-
-
-                st.plotly_chart(fig_diff_local, use_container_width=True)
-
-                # 🔀 Comparação Multichecks
-                st.markdown("### 🔹 Comparação Head x Múltiplos Checks")
-                st.markdown("""
-                <small>
-                Essa análise permite comparar um cultivar (Head) com vários outros (Checks) ao mesmo tempo. 
-                Ela apresenta o percentual de vitórias, produtividade média e a diferença média de performance 
-                em relação aos demais cultivares selecionados.
-                </small>
-                """, unsafe_allow_html=True)
-
-                head_unico = st.selectbox("Cultivar Head", options=cultivares_unicos, key="multi_head")
-                opcoes_checks = [c for c in cultivares_unicos if c != head_unico]
-                checks_selecionados = st.multiselect("Cultivares Check", options=opcoes_checks, key="multi_checks")
-
-                if head_unico and checks_selecionados:
-                    df_multi = df_resultado[
-                        (df_resultado["Head"] == head_unico) &
-                        (df_resultado["Check"].isin(checks_selecionados))
-                    ]
-
-                    if not df_multi.empty:
-                        prod_head_media = df_multi["Head_Mean"].mean().round(1)
-
-                        st.markdown(f"#### 🎯 Cultivar Head: **{head_unico}** | Produtividade Média: **{prod_head_media} sc/ha**")
-
-                        # Calcula diferença linha a linha
-                        df_multi["Diferenca_individual"] = df_multi["Head_Mean"] - df_multi["Check_Mean"]
-                        df_multi["Vitória"] = (df_multi["Difference (sc/ha)"] > 1).astype(int)
-                        df_multi["Empate"] = df_multi["Difference (sc/ha)"].between(-1, 1).astype(int)
-
-                        resumo = df_multi.groupby("Check").agg({
-                            "Diferenca_individual": "mean",
-                            "Vitória": "sum",
-                            "Empate": "sum",
-                            "Check_Mean": "mean",
-                            "Head_Mean": "mean"
-                        }).reset_index()
-
-                        resumo.rename(columns={
-                            "Check": "Cultivar Check",
-                            "Diferenca_individual": "Diferença Média",
-                            "Vitória": "Vitórias",
-                            "Empate": "Empates",
-                            "Check_Mean": "Prod_sc_ha_media",
-                            "Head_Mean": "Head_sc_ha_media"
-                        }, inplace=True)
-
-                        resumo["Num_Locais"] = df_multi.groupby("Check").size().values
-                        resumo["% Vitórias"] = (resumo["Vitórias"] / resumo["Num_Locais"] * 100).round(1)
-
-                        resumo[["Prod_sc_ha_media", "Head_sc_ha_media", "Diferença Média"]] = resumo[[
-                            "Prod_sc_ha_media", "Head_sc_ha_media", "Diferença Média"
-                        ]].round(1)
-
-                        resumo = resumo[[
-                            "Cultivar Check",
-                            "Num_Locais",
-                            "Prod_sc_ha_media",
-                            "Head_sc_ha_media",
-                            "Diferença Média",
-                            "% Vitórias"
-                        ]]
-
-                        col_tabela, col_grafico = st.columns([1.4, 1.6])
-
-                        with col_tabela:
-                            st.markdown("### 📊 Tabela Comparativa")
-                            gb = GridOptionsBuilder.from_dataframe(resumo)
-                            gb.configure_default_column(cellStyle={'fontSize': '14px'})
-                            gb.configure_grid_options(headerHeight=30)
-                            custom_css = {
-                                ".ag-header-cell-label": {
-                                    "font-weight": "bold",
-                                    "font-size": "15px",
-                                    "color": "black"
-                                }
-                            }
-
-                            AgGrid(resumo, gridOptions=gb.build(), height=400, custom_css=custom_css)
-
-                            # Exportação Excel
-                            buffer = io.BytesIO()
-                            with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-                                resumo.to_excel(writer, sheet_name="comparacao_multi_check", index=False)
-                            buffer.seek(0)
-
-                            st.download_button(
-                                label="📅 Baixar Comparação (Excel)",
-                                data=buffer.getvalue(),
-                                file_name=f"comparacao_{head_unico}_vs_checks.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                            )
-
-                        with col_grafico:
-                            fig_diff = go.Figure()
-                            cores_personalizadas = resumo["Diferença Média"].apply(
-                                lambda x: "#01B8AA" if x > 1 else "#FD625E" if x < -1 else "#F2C80F"
-                            )
-
-                            fig_diff.add_trace(go.Bar(
-                                y=resumo["Cultivar Check"],
-                                x=resumo["Diferença Média"],
-                                orientation='h',
-                                text=resumo["Diferença Média"].round(1),
-                                textposition="outside",
-                                textfont=dict(size=16, family="Arial Black", color="black"),
-                                marker_color=cores_personalizadas
-                            ))
-
-                            fig_diff.update_layout(
-                                title=dict(text="📊 Diferença Média de Produtividade", font=dict(size=20, family="Arial Black", color="black")),
-                                xaxis=dict(title=dict(text="Diferença Média (sc/ha)", font=dict(size=16, color="black")), tickfont=dict(size=14, color="black")),
-                                yaxis=dict(title=dict(text="Check", font=dict(size=14, color="black")), tickfont=dict(size=14, color="black")),
-                                margin=dict(t=30, b=40, l=60, r=30),
-                                height=400,
-                                showlegend=False
-                            )
-
-                            st.plotly_chart(fig_diff, use_container_width=True)
-                    else:
-                        st.info("❓ Nenhuma comparação disponível com os Checks selecionados.")
-
-
-
-
-
-
-
-            
-
-
-
-
-
-
-
-        
-
-
-
+            resultado = st.session_state["h2h_resultado"].reclassificar(limiar, relativo)
+            diagnostico.marcar("Reclassificação pela margem", len(resultado))
+            secao_resultado_h2h(resultado, tamanho_pagina, diagnostico=diagnostico)
+            secao_ranking(resultado, tamanho_pagina, diagnostico=diagnostico)
+            secao_comparacao(resultado, df, reamostragens, tamanho_pagina, diagnostico=diagnostico)
+            secao_multi_check(resultado, reamostragens, diagnostico=diagnostico)
+            secao_relatorio(resultado, diagnostico=diagnostico)
+
+            tarefa = st.session_state.get("relatorio_tarefa")
+            if tarefa is not None and not tarefa.pronta():
+                st.fragment(acompanhar_relatorio, run_every=INTERVALO_PROGRESSO)()
+
+diagnostico.marcar("Demais elementos")
+if mostrar_diagnostico:
+    with st.sidebar.expander("🩺 Etapas desta execução", expanded=True):
+        st.dataframe(diagnostico.tabela(), hide_index=True)
+        st.caption(f"Total: {diagnostico.total():.2f} s")
+diagnostico.gravar(sessao=st.session_state.setdefault("sessao_diagnostico", uuid.uuid4().hex[:8]))
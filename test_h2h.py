@@ -0,0 +1,281 @@
+"""Regressões do motor Head to Head: leitura, cálculo dos pares e seus derivados.
+
+Uso:
+
+    python -m pytest -q test_h2h.py
+"""
+import io
+import re
+import zipfile
+
+import pandas as pd
+import pytest
+
+import h2h
+from benchmark_h2h import gerar_ensaio, gerar_planilha
+from h2h import (
+    ErroIngestao, IndiceFiltros, ResultadoH2H, adicionar_dataset, agregar_repeticoes, calcular_h2h, carregar_dataset,
+    ler_excel, normalizar_dados, paginar, particoes_dataset
+)
+
+SEMENTES = [0, 1, 2]
+
+
+def _laco_original(df):
+    """Cálculo da primeira versão do app: laço por fazenda, primeira parcela de cada cultivar."""
+    resultados_h2h = []
+    for fazenda, grupo in df.groupby("Fazenda", observed=True):
+        cultivares = grupo["Cultivar"].unique()
+        for head in cultivares:
+            prod_head = grupo.loc[grupo["Cultivar"] == head, "prod_sc_ha"].values[0]
+            for check in cultivares:
+                if head == check:
+                    continue
+                prod_check = grupo.loc[grupo["Cultivar"] == check, "prod_sc_ha"].values[0]
+                diff = prod_head - prod_check
+                win = int(diff > 1)
+                draw = int(-1 <= diff <= 1)
+                resultados_h2h.append({
+                    "Fazenda": fazenda,
+                    "Head": head,
+                    "Check": check,
+                    "Head_Mean": round(prod_head, 1),
+                    "Check_Mean": round(prod_check, 1),
+                    "Difference (sc/ha)": round(diff, 1),
+                    "Vitória": win,
+                    "Empate": draw,
+                    "% Vitória": 100.0 if win else 0.0
+                })
+    return pd.DataFrame(resultados_h2h)
+
+
+def _ensaio(semente, n_fazendas=25, n_cultivares=10):
+    """Ensaio sintético com uma parcela por cultivar e uma safra por fazenda, como o laço supunha."""
+    return normalizar_dados(gerar_ensaio(n_fazendas, n_cultivares, semente=semente))
+
+
+@pytest.mark.parametrize("semente", SEMENTES)
+def test_calcular_h2h_igual_ao_laco_original(semente):
+    df = _ensaio(semente)
+    esperado = _laco_original(df)
+    obtido = calcular_h2h(df).drop(columns="Safra")
+    # O laço devolve os rótulos como texto
+    obtido[["Fazenda", "Head", "Check"]] = obtido[["Fazenda", "Head", "Check"]].astype(object)
+    pd.testing.assert_frame_equal(obtido, esperado, check_dtype=False)
+
+
+@pytest.mark.parametrize("semente", SEMENTES)
+@pytest.mark.parametrize("repeticoes", [1, 3])
+def test_totais_iguais_as_linhas(semente, repeticoes):
+    # Com repetições as médias caem fora da grade de 0,1 sc/ha
+    resultado = ResultadoH2H(normalizar_dados(gerar_ensaio(25, 10, repeticoes, semente=semente)))
+    tabela = resultado.tabela()
+    pares = tabela.groupby(["Head", "Check"], observed=True)
+    totais = resultado.totais.loc[list(pares.groups)]
+    assert (totais["Num_Locais"].to_numpy() == pares.size().to_numpy()).all()
+    assert (totais["Vitorias"].to_numpy() == pares["Vitória"].sum().to_numpy()).all()
+    assert (totais["Empates"].to_numpy() == pares["Empate"].sum().to_numpy()).all()
+
+
+def _com_dimensao(planilha, dimensao):
+    """Reescreve a tag <dimension> da primeira aba, como fazem alguns exportadores."""
+    origem, destino = zipfile.ZipFile(io.BytesIO(planilha)), io.BytesIO()
+    with zipfile.ZipFile(destino, "w") as saida:
+        for item in origem.infolist():
+            conteudo = origem.read(item)
+            if item.filename == "xl/worksheets/sheet1.xml":
+                conteudo = re.sub(rb'<dimension ref="[^"]*"/>', f'<dimension ref="{dimensao}"/>'.encode(), conteudo)
+            saida.writestr(item, conteudo)
+    return destino.getvalue()
+
+
+def test_ler_excel_igual_ao_pandas():
+    df = gerar_ensaio(10, 8, semente=3)
+    planilha = gerar_planilha(df)
+    obtido = ler_excel(io.BytesIO(planilha))
+    esperado = normalizar_dados(pd.read_excel(io.BytesIO(planilha)))
+    pd.testing.assert_frame_equal(obtido.reset_index(drop=True), esperado.reset_index(drop=True), check_dtype=False, check_categorical=False)
+
+
+def test_ler_excel_ignora_dimensao_desatualizada():
+    planilha = gerar_planilha(gerar_ensaio(10, 8, semente=3))
+    assert len(ler_excel(io.BytesIO(_com_dimensao(planilha, "A1:C3")))) == len(ler_excel(io.BytesIO(planilha)))
+
+
+def test_ler_excel_blocos_com_rotulos_mistos(monkeypatch):
+    df = gerar_ensaio(30, 8, semente=4)
+    df["Safra"] = df["Safra"].astype(object)
+    df.loc[:50, "Safra"] = 2023
+    planilha = gerar_planilha(df)
+    inteiro = ler_excel(io.BytesIO(planilha))
+    monkeypatch.setattr(h2h, "LINHAS_POR_BLOCO", 40)
+    pd.testing.assert_frame_equal(ler_excel(io.BytesIO(planilha)), inteiro)
+
+
+def test_ler_excel_sem_colunas_obrigatorias():
+    planilha = gerar_planilha(gerar_ensaio(5, 4).drop(columns=["Cultivar"]))
+    with pytest.raises(ErroIngestao, match="Cultivar"):
+        ler_excel(io.BytesIO(planilha))
+
+
+@pytest.mark.parametrize("semente", SEMENTES)
+def test_incremental_igual_ao_recalculo(semente):
+    df = _ensaio(semente, n_fazendas=40)
+    anterior = ResultadoH2H(df)
+    for filtrado in (df[df["Estado"] != "MT"], df[df["GM"] < df["GM"].median()], df):
+        pd.testing.assert_frame_equal(ResultadoH2H(filtrado, anterior=anterior).totais, ResultadoH2H(filtrado).totais)
+
+
+def test_indice_filtros_igual_ao_pandas():
+    df = _ensaio(0, n_fazendas=40)
+    dados = IndiceFiltros(df)
+    estados = dados.opcoes("Estado")
+    assert estados == df["Estado"].unique().tolist()
+
+    mascara = dados.restringir(None, "Estado", estados[:2])
+    cidades = dados.opcoes("Cidade", mascara)
+    assert set(cidades) == set(df.loc[df["Estado"].isin(estados[:2]), "Cidade"])
+    mascara = dados.restringir(mascara, "Cidade", cidades[1:])
+    mascara = dados.restringir_faixa(mascara, "GM", 60, 75)
+
+    esperado = df[df["Estado"].isin(estados[:2]) & df["Cidade"].isin(cidades[1:]) & df["GM"].between(60, 75)]
+    pd.testing.assert_frame_equal(dados.filtrar(mascara), esperado)
+    assert dados.faixa("GM", mascara) == (esperado["GM"].min(), esperado["GM"].max())
+
+
+def test_paginar():
+    df = pd.DataFrame({"Cultivar": [f"CV {i:02d}" for i in range(25)], "prod_sc_ha": range(25)})
+    fatia, total = paginar(df, 3, 10)
+    assert total == 25 and fatia["prod_sc_ha"].tolist() == list(range(20, 25))
+    fatia, total = paginar(df, 1, 5, ordenar_por="prod_sc_ha", crescente=False)
+    assert fatia["prod_sc_ha"].tolist() == [24, 23, 22, 21, 20]
+    fatia, total = paginar(df, 1, 10, filtro=("Cultivar", "cv 1"))
+    assert total == 10 and fatia["Cultivar"].str.startswith("CV 1").all()
+    assert paginar(df, 9, 10)[0].empty
+    assert paginar(df, 1, 30, filtro=("prod_sc_ha", ">= 20,5"))[1] == 4
+    with pytest.raises(ValueError):
+        paginar(df, 1, 10, filtro=("prod_sc_ha", "abc"))
+
+
+def test_base_com_planilhas_de_colunas_diferentes(tmp_path):
+    raiz = str(tmp_path / "base")
+    completa = gerar_ensaio(10, 5, semente=1)
+    parcial = gerar_ensaio(10, 5, semente=2).drop(columns=["GM", "Microrregiao"])
+    parcial["Fazenda"] = parcial["Fazenda"].str.replace("Fazenda", "Outra")
+    adicionar_dataset(gerar_planilha(completa), raiz)
+    adicionar_dataset(gerar_planilha(parcial), raiz)
+
+    dados = carregar_dataset(particoes_dataset(raiz), raiz)
+    assert len(dados.df) == len(completa) + len(parcial)
+
+    # Seleção padrão do app: todas as opções e a faixa inteira de GM
+    microrregioes = dados.opcoes("Microrregiao")
+    assert microrregioes[-1] is None
+    mascara = dados.restringir(None, "Microrregiao", microrregioes)
+    mascara = dados.restringir_faixa(mascara, "GM", *dados.faixa("GM", mascara))
+    assert mascara.all()
+    # Só as linhas sem valor
+    assert dados.restringir(None, "Microrregiao", [None]).sum() == len(parcial)
+
+
+def test_intervalos_nao_dependem_dos_blocos(monkeypatch):
+    df = _ensaio(0, n_fazendas=40)
+    chaves = list(ResultadoH2H(df).totais.index[:60])
+    inteiro = ResultadoH2H(df).intervalos(chaves, reamostragens=200)
+    monkeypatch.setattr(h2h, "ELEMENTOS_POR_BLOCO", 1)
+    pd.testing.assert_frame_equal(ResultadoH2H(df).intervalos(chaves, reamostragens=200), inteiro)
+
+    totais = ResultadoH2H(df).totais.loc[chaves]
+    media = (totais["Soma_Head"] - totais["Soma_Check"]) / (10 * totais["Num_Locais"])
+    assert ((inteiro["Dif_IC_Inf"] <= media.round(1) + 0.1) & (media.round(1) - 0.1 <= inteiro["Dif_IC_Sup"])).all()
+
+
+def test_agregados_somam_os_totais():
+    resultado = ResultadoH2H(_ensaio(2))
+    for nivel in resultado.niveis():
+        agregado = resultado.agregado(nivel)
+        assert not {"Soma_Head", "Soma_Check"} & set(agregado.columns)
+        soma = agregado.groupby(["Head", "Check"], observed=True)[["Num_Locais", "Vitorias", "Empates", "Derrotas"]].sum()
+        esperado = resultado.totais.loc[soma.index, soma.columns]
+        assert (soma.to_numpy() == esperado.to_numpy()).all(), nivel
+
+
+def test_fazenda_em_duas_safras_entra_nas_duas():
+    df = normalizar_dados(pd.DataFrame({
+        "Fazenda": ["F1", "F1", "F1", "F1", "F2", "F2"],
+        "Cultivar": ["A", "B", "A", "B", "A", "B"],
+        "prod_sc_ha": [60.0, 55.0, 70.0, 62.0, 50.0, 52.0],
+        "Safra": ["S1", "S1", "S2", "S2", "S1", "S1"],
+        "Estado": ["MT"] * 6
+    }))
+    safra = ResultadoH2H(df).agregado("Safra").set_index(["Safra", "Head", "Check"])
+    assert safra.loc[("S1", "A", "B"), ["Num_Locais", "Vitorias", "Derrotas", "Head_Mean"]].tolist() == [2, 1, 1, 55.0]
+    assert safra.loc[("S2", "A", "B"), ["Num_Locais", "Vitorias", "Derrotas", "Head_Mean"]].tolist() == [1, 1, 0, 70.0]
+
+
+def test_paralelo_igual_ao_serial():
+    df = _ensaio(0, n_fazendas=60)
+    serial = ResultadoH2H(df)
+    paralelo = ResultadoH2H(df, processos=2)
+    pd.testing.assert_frame_equal(paralelo.totais, serial.totais)
+    pd.testing.assert_frame_equal(paralelo.tabela(), serial.tabela())
+
+
+@pytest.mark.parametrize("limiar, relativo", [(0.0, False), (3.0, False), (5.0, True)])
+def test_reclassificar_igual_ao_recalculo(limiar, relativo):
+    df = _ensaio(1)
+    reclassificado = ResultadoH2H(df).reclassificar(limiar, relativo)
+    novo = ResultadoH2H(df, limiar=limiar, relativo=relativo)
+    pd.testing.assert_frame_equal(reclassificado.totais, novo.totais)
+    pd.testing.assert_frame_equal(reclassificado.tabela(), novo.tabela())
+
+
+def test_par_classifica_medias_como_os_totais():
+    # Média 61,05 contra 60,0: diferença de 1,05 arredonda para 1,0 e é empate
+    df = normalizar_dados(pd.DataFrame({
+        "Fazenda": ["F1", "F1", "F1", "F2", "F2"],
+        "Cultivar": ["A", "A", "B", "A", "B"],
+        "prod_sc_ha": [61.0, 61.1, 60.0, 70.0, 60.0]
+    }))
+    resultado = ResultadoH2H(df)
+    par = resultado.par("A", "B")
+    assert par["Vitória"].tolist() == [0, 1] and par["Empate"].tolist() == [1, 0]
+    totais = resultado.totais_par("A", "B")
+    assert (totais["Vitorias"], totais["Empates"]) == (par["Vitória"].sum(), par["Empate"].sum())
+
+
+def test_so_a_margem_atual_guarda_derivados():
+    resultado = ResultadoH2H(_ensaio(1))
+    resultado.ranking()
+    outra = resultado.reclassificar(3.0)
+    outra.ranking()
+    outra.agregado("Estado")
+    assert resultado._ranking is None
+    resultado.reclassificar(5.0, True)
+    assert outra._ranking is None and outra._agregados is None
+
+
+def test_agregar_repeticoes():
+    df = normalizar_dados(pd.DataFrame({
+        "Safra": ["S1", "S1", "S1", "S2", "S1"],
+        "Fazenda": ["F2", "F2", "F2", "F2", "F1"],
+        "Cultivar": ["B", "A", "B", "B", "A"],
+        "prod_sc_ha": [60.0, 55.0, 64.0, 70.0, 50.0],
+        "Estado": ["MT", "MT", "GO", "MT", "PR"]
+    }))
+    agregado = agregar_repeticoes(df)
+    assert list(agregado.columns) == list(df.columns) + ["Parcelas", "Variancia_sc_ha"]
+    # Grupos na ordem em que aparecem; demais colunas da primeira parcela
+    assert agregado[["Safra", "Fazenda", "Cultivar"]].astype(str).values.tolist() == [
+        ["S1", "F2", "B"], ["S1", "F2", "A"], ["S2", "F2", "B"], ["S1", "F1", "A"]
+    ]
+    assert agregado["prod_sc_ha"].tolist() == [62.0, 55.0, 70.0, 50.0]
+    assert agregado["Parcelas"].tolist() == [2, 1, 1, 1]
+    assert agregado["Variancia_sc_ha"].iloc[0] == 8.0 and agregado["Variancia_sc_ha"].iloc[1:].isna().all()
+    assert agregado["Estado"].tolist() == ["MT", "MT", "MT", "PR"]
+
+
+def test_resultado_nao_depende_da_ordem_das_parcelas():
+    df = normalizar_dados(gerar_ensaio(30, 10, 3, semente=5))
+    embaralhado = df.sample(frac=1, random_state=1)
+    pd.testing.assert_frame_equal(ResultadoH2H(embaralhado).totais, ResultadoH2H(df).totais)